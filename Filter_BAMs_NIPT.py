@@ -1,5 +1,6 @@
 #! /usr/bin/env python
-import sys,os,commands
+import sys,os,commands,subprocess,tempfile,threading,hashlib,time,re,json,socket
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from optparse import OptionGroup
 
@@ -12,31 +13,255 @@ from optparse import OptionGroup
 #		Script is modified to structure of NIPT (UMCU)
 ##################################################################################################
 
+MANIFEST_FIELDS=["input","input_size","input_mtime","output","output_size","output_md5","status","stage","exit_code"]
+METRICS_FIELDS=["sample","host","stage","exit_code","wall_seconds","user_seconds","system_seconds","bytes_in","bytes_out","duplicates"]
+
+def md5sum(filename):
+	md5=hashlib.md5()
+	h=open(filename,"rb")
+	for block in iter(lambda: h.read(1024*1024),""):
+		md5.update(block)
+	h.close()
+	return md5.hexdigest()
+
+def read_manifest(manifest_filename):
+	"""Returns the manifest entries by input BAM name, empty if there is no manifest yet"""
+	manifest={}
+	if os.path.isfile(manifest_filename):
+		h=open(manifest_filename)
+		fields=h.readline().rstrip("\n").split("\t")
+		for line in h:
+			entry=dict(zip(fields,line.rstrip("\n").split("\t")))
+			manifest[entry["input"]]=entry
+		h.close()
+	return manifest
+
+def write_manifest(manifest_filename,manifest):
+	"""Rewrites the manifest through a temporary file, so an interrupted run leaves a complete one"""
+	h=open(manifest_filename+".tmp","w")
+	h.write("\t".join(MANIFEST_FIELDS)+"\n")
+	for name in sorted(manifest):
+		h.write("\t".join([str(manifest[name].get(field,"")) for field in MANIFEST_FIELDS])+"\n")
+	h.close()
+	os.rename(manifest_filename+".tmp",manifest_filename)
+
+def is_complete(item,entry,verify):
+	"""Tells whether the manifest entry of item records a finished run for the current input.
+
+	The input must have the recorded size and mtime, the output the recorded
+	size (and with verify its MD5), and the index must start with the BAI
+	magic and not be older than the output.
+	"""
+	subopt=str(item)[0:-4]+"_u0mm_subopt.bam"
+	if entry is None or entry.get("status") != "done":
+		return False
+	try:
+		stat=os.stat(item)
+		if str(stat.st_size) != entry["input_size"] or "%.6f" % stat.st_mtime != entry["input_mtime"]:
+			return False
+		if str(os.path.getsize(subopt)) != entry["output_size"]:
+			return False
+		if os.path.getmtime(subopt+".bai") < os.path.getmtime(subopt):
+			return False
+		h=open(subopt+".bai","rb")
+		magic=h.read(4)
+		h.close()
+		if magic != "BAI\x01":
+			return False
+	except OSError:
+		return False
+	if verify and md5sum(subopt) != entry["output_md5"]:
+		return False
+	return True
+
+def size(filename):
+	if os.path.isfile(filename):
+		return os.path.getsize(filename)
+	return 0
+
+def run(command, **kwargs):
+	"""Runs a command (an argument list) and returns its exit code (127 if it can not be started), wall time and CPU time.
+
+	The child is reaped with os.wait4, which gives the CPU time of that one
+	child even while other samples run concurrently.
+	"""
+	start=time.time()
+	try:
+		process=subprocess.Popen(command, **kwargs)
+	except OSError, e:
+		sys.stderr.write("Can not run "+str(command[0])+": "+str(e)+"\n")
+		return 127,{"wall_seconds":0.0,"user_seconds":0.0,"system_seconds":0.0}
+	pid,status,usage=os.wait4(process.pid,0)
+	if os.WIFSIGNALED(status):
+		process.returncode=-os.WTERMSIG(status)
+	else:
+		process.returncode=os.WEXITSTATUS(status)
+	return process.returncode,{"wall_seconds":round(time.time()-start,3),"user_seconds":round(usage.ru_utime,3),"system_seconds":round(usage.ru_stime,3)}
+
+def stage_metrics(stage,code,timing,bytes_in,bytes_out,duplicates=None):
+	metrics={"stage":stage,"exit_code":code,"bytes_in":bytes_in,"bytes_out":bytes_out,"duplicates":duplicates}
+	metrics.update(timing)
+	return metrics
+
+def read_metrics(metrics_filename):
+	"""Returns the per-sample metrics of earlier runs by sample name"""
+	if not os.path.isfile(metrics_filename):
+		return {}
+	h=open(metrics_filename)
+	metrics=json.load(h)
+	h.close()
+	return dict([(sample["sample"],sample) for sample in metrics])
+
+def write_metrics(metrics_filename,metrics):
+	"""Writes the per-sample metrics as JSON and one row per sample and stage to the .tsv next to it"""
+	h=open(metrics_filename+".tmp","w")
+	json.dump([metrics[name] for name in sorted(metrics)],h,indent=1,sort_keys=True)
+	h.close()
+	os.rename(metrics_filename+".tmp",metrics_filename)
+	h=open(metrics_filename[0:-5]+".tsv","w")
+	h.write("\t".join(METRICS_FIELDS)+"\n")
+	for name in sorted(metrics):
+		for stage in metrics[name]["stages"]:
+			row=dict(stage,sample=name,host=metrics[name]["host"])
+			h.write("\t".join(["" if row.get(field) is None else str(row[field]) for field in METRICS_FIELDS])+"\n")
+	h.close()
+
+def write_dedup(dedup_filename,item,log):
+	"""Replaces the markdup log block of item in dedup.txt, or appends it.
+
+	A block starts with the line of the BAM name without .bam. Blocks of
+	earlier runs of the same sample (with -f, or a retried failure) are
+	dropped, so every sample has one block. Rewritten through a temporary file.
+	"""
+	header=str(item)[0:-4]
+	blocks=[]
+	if os.path.isfile(dedup_filename):
+		h=open(dedup_filename)
+		for line in h:
+			if os.path.isfile(line.rstrip("\n")+".bam") or not blocks:
+				blocks.append([line.rstrip("\n"),line])
+			else:
+				blocks[-1][1]+=line
+		h.close()
+	h=open(dedup_filename+".tmp","w")
+	for name,block in blocks:
+		if name != header:
+			h.write(block)
+	h.write(header+"\n"+log)
+	h.close()
+	os.rename(dedup_filename+".tmp",dedup_filename)
+
+def process_bam(item,dedup_filename,lock):
+	"""Filters, deduplicates and indexes one BAM with sambamba.
+
+	Returns (item, failed stage or None, exit code, MD5 of the output, metrics).
+	The metrics hold the wall time, CPU time and bytes in/out of every stage
+	and the number of duplicates markdup found. The markdup log is
+	collected and written to dedup.txt in one piece (see write_dedup), so
+	concurrent samples do not interleave. With a tmpdir (e.g. /dev/shm) the filtered BAM is
+	written there uncompressed, so it never touches the shared filesystem.
+	markdup reads its input twice, so it can not be streamed through a FIFO.
+	"""
+	with lock:
+		print "removing non-unique and reads with mismatch, suboptimal hits, and removing duplicates"+"\t" + str(item)
+	subopt=str(item)[0:-4]+"_u0mm_subopt.bam"
+	if tmpdir is None:
+		temp=str(item)[0:-4]+"temp.bam"
+		view=[str(opt.sambamba),"view","-f","bam","--filter=[X1]==0 and [CM]==0 and [XT]=='U'",str(item),"-o",temp,"-t",str(threads)]
+		markdup=[str(opt.sambamba),"markdup","-r",temp,"-t",str(threads),subopt]
+	else:
+		temp=os.path.join(tmpdir,os.path.basename(str(item))[0:-4]+"temp.bam")
+		view=[str(opt.sambamba),"view","-f","bam","-l","0","--filter=[X1]==0 and [CM]==0 and [XT]=='U'",str(item),"-o",temp,"-t",str(threads)]
+		markdup=[str(opt.sambamba),"markdup","-r","--tmpdir="+tmpdir,temp,"-t",str(threads),subopt]
+	metrics={"sample":os.path.basename(str(item)),"host":socket.gethostname(),"stages":[]}
+	code,timing=run(view)
+	metrics["stages"].append(stage_metrics("view",code,timing,size(item),size(temp)))
+	if code != 0:
+		if os.path.isfile(temp):
+			os.remove(temp)
+		return item,"view",code,"",metrics
+	log=tempfile.TemporaryFile()
+	code,timing=run(markdup,stderr=log)
+	log.seek(0)
+	log=log.read()
+	duplicates=re.search(r"found (\d+) duplicates",log)
+	if duplicates is not None:
+		duplicates=int(duplicates.group(1))
+	metrics["stages"].append(stage_metrics("markdup",code,timing,size(temp),size(subopt),duplicates))
+	with lock:
+		write_dedup(dedup_filename,item,log)
+	os.remove(temp)
+	if code != 0:
+		return item,"markdup",code,"",metrics
+	code,timing=run([str(opt.sambamba),"index","-t",str(threads),subopt])
+	metrics["stages"].append(stage_metrics("index",code,timing,size(subopt),size(subopt+".bai")))
+	if code != 0:
+		return item,"index",code,"",metrics
+	return item,None,0,md5sum(subopt),metrics
 
 def filter(list,wkdir): 
-	if os.path.isfile(str(wkdir)+"dedup.txt") == True:
-		os.system("rm dedup.txt")
+	"""Processes the BAMs in jobs concurrent workers of threads sambamba threads each.
+
+	Samples that the manifest records as done for the current input, with a
+	complete output and index, are skipped (unless force). Every finished
+	or failed sample is recorded in the manifest right away, so an
+	interrupted run resumes where it stopped. The metrics of every sample
+	go to filter_metrics.json and filter_metrics.tsv, keeping those of
+	skipped samples from earlier runs. Returns the (item, stage, exit code)
+	of the samples that failed.
+	"""
+	dedup_filename=str(wkdir)+"dedup.txt"
+	manifest_filename=os.path.join(str(wkdir),"filter_manifest.tsv")
+	manifest=read_manifest(manifest_filename)
+	metrics_filename=os.path.join(str(wkdir),"filter_metrics.json")
+	metrics=read_metrics(metrics_filename)
+	todo=[]
 	for item in list:
-			print "removing non-unique and reads with mismatch, suboptimal hits, and removing duplicates"+"\t" + str(item)
-			os.system(str(opt.sambamba) +" view -f bam --filter=\"[X1]==0 and [CM]==0 and [XT]==\'U\'\" " +str(item) + " -o "+ str(item)[0:-4]+"temp.bam -t "+str(threads))
-			os.system("echo "+str(item[0:-4])+ " >> "+str(wkdir)+"dedup.txt")
-			os.system(str(opt.sambamba)+ " markdup -r "+str(item)[0:-4]+"temp.bam"+ " -t "+str(threads)+ " " +str(item[0:-4]) + "_u0mm_subopt.bam 2>> "+str(wkdir)+"dedup.txt")
-			os.system("rm "+str(item)[0:-4]+"temp.bam")
-			os.system(str(opt.sambamba)+ " index -t "+str(threads)+ " " +str(item[0:-4]) + "_u0mm_subopt.bam")
-	return list
+		if not force and is_complete(item,manifest.get(os.path.basename(item)),verify):
+			print "skipping, already filtered and deduplicated"+"\t"+str(item)
+		else:
+			stat=os.stat(item)
+			manifest[os.path.basename(item)]={"input":os.path.basename(item),"input_size":stat.st_size,
+				"input_mtime":"%.6f" % stat.st_mtime,"output":os.path.basename(str(item)[0:-4]+"_u0mm_subopt.bam"),
+				"status":"running"}
+			todo+= [item]
+	write_manifest(manifest_filename,manifest)
+	lock=threading.Lock()
+	failed=[]
+	pool=ThreadPool(jobs)
+	try:
+		for item,stage,code,md5,sample_metrics in pool.imap_unordered(lambda item: process_bam(item,dedup_filename,lock),todo):
+			metrics[sample_metrics["sample"]]=sample_metrics
+			write_metrics(metrics_filename,metrics)
+			entry=manifest[os.path.basename(item)]
+			entry["exit_code"]=code
+			if stage is not None:
+				print "sambamba "+stage+" failed with exit code "+str(code)+"\t"+str(item)
+				failed+= [(item,stage,code)]
+				entry["status"]="failed"
+				entry["stage"]=stage
+			else:
+				entry["status"]="done"
+				entry["output_size"]=os.path.getsize(str(item)[0:-4]+"_u0mm_subopt.bam")
+				entry["output_md5"]=md5
+			write_manifest(manifest_filename,manifest)
+	finally:
+		pool.close()
+		pool.join()
+	return failed
 
 def listbams(wkdir):
 	list=[]
 
-	for file in os.listdir(str(wkdir)):
-		if "bam" in file and "bai" not in file and "temp" not in file and "subopt" not in file and "sambam" not in file:
+	for file in sorted(os.listdir(str(wkdir))):
+		if file.endswith(".bam") and not file.endswith("temp.bam") and not file.endswith("_u0mm_subopt.bam") and os.path.isfile(os.path.join(str(wkdir),file)):
         		list+= [str(wkdir)+"/"+str(file)]
 
 	if len(list) == 0:
 		print "No BAMs detected"
 		sys.exit()
         else:
-		filter(list,wkdir)
+		return filter(list,wkdir)
 	
 ####################################################################################################
 
@@ -46,6 +271,10 @@ if __name__ == "__main__":
         group.add_option("-x", default="./", dest="wkdir", metavar="[STRING]", help="Working directory [default = \"./\"] ")
         group.add_option("-s", default="./sambamba_v0.4.5", dest="sambamba", metavar="[STRING]", help="full path to SamBamBa binary [default = ./sambamba_v0.4.5]")
 	group.add_option("-t", default=4, dest="threads", metavar="[INT]", help="number of threads for sambamba [default = 4]")
+	group.add_option("-T", default=None, dest="tmpdir", metavar="[STRING]", help="local scratch directory, e.g. /dev/shm, for the filtered BAM between filter and markdup; it is written there uncompressed [default = compressed next to the input BAM]")
+	group.add_option("-f", default=False, action="store_true", dest="force", help="process all BAMs again, also those the manifest (filter_manifest.tsv) records as done")
+	group.add_option("-m", default=False, action="store_true", dest="verify", help="when skipping done BAMs, also compare the MD5 of their output with the manifest")
+	group.add_option("-c", default=None, dest="cores", metavar="[INT]", help="total number of cores; BAMs are processed concurrently as cores/threads jobs, e.g. -c 32 -t 4 runs 8 BAMs at a time [default = threads, one BAM at a time]")
 	parser.add_option_group(group)
         (opt, args) = parser.parse_args()
 	
@@ -53,9 +282,21 @@ if __name__ == "__main__":
 		threads=1
 	else:
 		threads=int(opt.threads)	
+	if opt.cores is None:
+		jobs=1
+	else:
+		jobs=max(1,int(opt.cores)/max(threads,1))
+	
+	tmpdir=opt.tmpdir
+	force=opt.force
+	verify=opt.verify
+	if tmpdir is not None and not os.path.isdir(tmpdir):
+		sys.exit("Scratch directory "+str(tmpdir)+" does not exist")
 	
 	wkdir=str(opt.wkdir)
-	listbams(wkdir)
+	failed=listbams(wkdir)
+	if failed:
+		sys.exit("Failed samples: "+", ".join([str(item)+" ("+stage+")" for item,stage,code in failed]))
 
 sys.exit("Finished")
 
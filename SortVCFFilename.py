@@ -2,10 +2,46 @@
 """
 
 Sorts a VCF (http://vcftools.sourceforge.net/specs.html) file according to position of the variants.
-All the sorting happens in memory (tested for 150MB of VCF)
+By default all the sorting happens in memory (tested for 150MB of VCF)
 Usage: 
 #> python SortVCFFilename.py <inputVCFFilename.vcf> <outputVCFFilename>
 
+For files that do not fit in memory use the external sort mode, which sorts
+runs of at most MB megabytes, spills them to temporary files and merges them.
+The output is identical to the in-memory sort:
+#> python SortVCFFilename.py --max-memory 2000 --tmp-dir /local/scratch <inputVCFFilename.vcf> <outputVCFFilename>
+
+To sort without holding the records in memory, keep only their position, byte offset
+and length (about 20 bytes per record) and copy them through an mmap of the input.
+NumPy is used for the sort when it is installed:
+#> python SortVCFFilename.py --index-sort <inputVCFFilename.vcf> <outputVCFFilename>
+
+Contigs are independent, so they can be sorted in parallel processes:
+#> python SortVCFFilename.py --threads 24 <inputVCFFilename.vcf> <outputVCFFilename>
+
+Files that are each already sorted, such as per-chromosome or per-batch VCFs with
+the same samples, can be merged without sorting them again:
+#> python SortVCFFilename.py --merge <sorted1.vcf> <sorted2.vcf> .. <outputVCFFilename>
+The merge fails if an input is not sorted or a contig is not declared. The output
+header has the ##contig lines of all inputs. Inputs that declare different contigs
+(e.g. one per shard) are merged in the order 1..22, X, Y, MT; for other contigs give
+their order with --fai.
+
+Inputs can be plain, gzip or BGZF compressed. The output can be written as BGZF
+with a tabix (.tbi) or CSI (.csi) index built in the same pass:
+#> python SortVCFFilename.py --bgzf --index tbi <inputVCFFilename.vcf.gz> <outputVCFFilename.vcf.gz>
+
+Already sorted inputs are detected in one streaming pass and copied (or with
+--hardlink, hardlinked) to the output instead of sorted, unless --no-fast-path is
+given or the output needs another compression or an index. Only check the order,
+reporting the first out-of-order record:
+#> python SortVCFFilename.py --check <inputVCFFilename.vcf>
+
+Contigs are sorted in the order of the ##contig header lines, or of a reference .fai:
+#> python SortVCFFilename.py --fai human_g1k_v37.fasta.fai <inputVCFFilename.vcf> <outputVCFFilename>
+Without either, 1..22, X, Y, MT come first. Undeclared contigs (GL*, NT_*, decoys)
+follow in order of first appearance.
+
 
 alexandros.kanterakis@gmail.com
 Genomics Coordination Center / UMC Groningen
@@ -14,90 +50,832 @@ Genomics Coordination Center / UMC Groningen
 
 import os
 import sys
+import gzip
+import heapq
+import io
+import itertools
+import mmap
+import multiprocessing
+import optparse
+import shutil
+import struct
+import tempfile
+import zlib
+from array import array
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+#Maximum number of runs that are merged at once. More runs are first merged into larger runs.
+MAX_MERGE_FANIN = 256
+
+GZIP_MAGIC = '\x1f\x8b'
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+#Maximum uncompressed size of a BGZF block, as written by htslib
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC' + \
+	'\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+#Index binning as written by tabix: 16kb windows, 5 levels for .tbi, 6 levels for .csi
+INDEX_MIN_SHIFT = 14
+TBI_DEPTH = 5
+CSI_DEPTH = 6
 
 def DeleteFilename(filename=None):
 	os.remove(filename)
 
-def ChrToInt(chr):
-        if chr == "X": return 23
-        if chr == "Y": return 24
-        if chr == "M" or chr == "MT": return 25
+#Contig order used when the header declares no ##contig lines and no .fai is given
+DEFAULT_CONTIGS = [[str(chr), 'chr' + str(chr)] for chr in range(1, 23)] + \
+	[['X', 'chrX'], ['Y', 'chrY'], ['M', 'MT', 'chrM', 'chrMT']]
 
-	try:
-        	return int(chr)
-	except:
-		print "Invalid chromosome value: ", chr
-		return 0
+#Records with a POS that is not an integer go after all other records of their contig
+UNPARSABLE_POS = 0xFFFFFFFF
+
+class SortVCFError(Exception):
+	"""Raised when inputs can not be merged or are not sorted"""
 
+class ContigOrder(object):
+	"""
+	Ranks contigs by the order of the ##contig header lines or of a reference .fai.
+	Contigs that are not declared are ranked after all declared ones, in order of first appearance.
+	With strict=True they raise a SortVCFError instead, for merges where the order
+	of first appearance differs between inputs.
+	"""
 
-def sortFunction(x,y):
-        splittedX = x.split("\t")
-        splittedY = y.split("\t")
+	def __init__(self, contigs=None, strict=False):
+		self.ranks = {}
+		self.declared = bool(contigs)
+		self.strict = strict
+		if self.declared:
+			for contig in contigs: self.ranks.setdefault(contig, len(self.ranks))
+		else:
+			for rank, names in enumerate(DEFAULT_CONTIGS):
+				for name in names: self.ranks[name] = rank
+		self.nextRank = max(self.ranks.values()) + 1
 
-        if splittedX[0] != splittedY[0]:
-                return ChrToInt(splittedX[0]) - ChrToInt(splittedY[0])
+	def Rank(self, contig):
+		rank = self.ranks.get(contig)
+		if rank is None:
+			if self.strict:
+				raise SortVCFError("contig " + contig + " is not declared in the header or .fai, can not merge it")
+			if self.declared:
+				print "WARNING: contig", contig, "is not declared in the header or .fai, sorting it after the declared contigs"
+			rank = self.ranks[contig] = self.nextRank
+			self.nextRank += 1
+		return rank
 
-	if len(splittedX) < 2 and len(splittedY) < 2:
-		return 1 if splittedX[0] < splittedY[0] else -1
-	if len(splittedX) < 2: return 1
-	if len(splittedY) < 2: return -10
+def ReadContigLinesFromHeader(headerLines):
+	"""Returns (contig ID, header line) of the ##contig=<ID=..> header lines in order"""
+	contigs = []
+	for line in headerLines:
+		if line.startswith('##contig=<'):
+			for field in line.rstrip('\r\n')[len('##contig=<'):].rstrip('>').split(','):
+				if field.startswith('ID='):
+					contigs.append((field[len('ID='):], line))
+					break
+	return contigs
 
-	ret = 0
+def ReadContigsFromHeader(headerLines):
+	"""Returns the contig IDs of the ##contig=<ID=..> header lines in order"""
+	return [contig for contig, _ in ReadContigLinesFromHeader(headerLines)]
 
+def MergeContigs(headers, faiFilename=None):
+	"""
+	Returns the contig order of a merge and the ##contig lines of its output: the union of
+	the ##contig lines of all inputs (the first line of every ID), in the order of the merge.
+	The order is that of faiFilename if given, else that of the ##contig lines if all inputs
+	declare the same ones, else 1..22, X, Y, MT. Inputs that declare different contigs, some of
+	them not in 1..22, X, Y, MT, raise a SortVCFError, as their order would depend on the order
+	of the inputs.
+	"""
+	contigLines = [ReadContigLinesFromHeader(headerLines) for headerLines, _ in headers]
+	union = []
+	seen = set()
+	for inputContigLines in contigLines:
+		for contig, line in inputContigLines:
+			if contig not in seen:
+				seen.add(contig)
+				union.append((contig, line))
+	if faiFilename is not None:
+		contigOrder = ContigOrder(ReadContigsFromFai(faiFilename), strict=True)
+	elif all([[contig for contig, _ in inputContigLines] == [contig for contig, _ in contigLines[0]]
+			for inputContigLines in contigLines]):
+		contigOrder = ContigOrder([contig for contig, _ in union], strict=True)
+	else:
+		contigOrder = ContigOrder(strict=True)
+		unknown = [contig for contig, _ in union if contig not in contigOrder.ranks]
+		if unknown:
+			raise SortVCFError("the inputs declare different ##contig lines, and the order of " + ", ".join(unknown[:10]) +
+				" is not known; give their order with --fai")
+		print "The inputs declare different ##contig lines, ordering them as 1..22, X, Y, MT"
+	#contigs that are not in the .fai keep their place after the others, their records raise a SortVCFError
+	ranks = dict([(contig, contigOrder.ranks.get(contig, contigOrder.nextRank + index)) for index, (contig, _) in enumerate(union)])
+	union.sort(key=lambda contigLine: ranks[contigLine[0]])
+	return contigOrder, [line for _, line in union]
+
+def ReplaceContigLines(headerLines, contigLines):
+	"""Returns headerLines with its ##contig lines replaced by contigLines, at the place of the first one (or before #CHROM)"""
+	if not contigLines:
+		return headerLines
+	others = [line for line in headerLines if not line.startswith('##contig=<')]
+	places = [index for index, line in enumerate(headerLines) if line.startswith('##contig=<')]
+	if places:
+		place = places[0]
+	else:
+		place = len([line for line in others if not line.startswith('#CHROM')])
+	return others[:place] + contigLines + others[place:]
+
+def ReadContigsFromFai(faiFilename):
+	"""Returns the contig names of a reference .fai (samtools faidx) in order"""
+	return [line.split('\t', 1)[0] for line in open(faiFilename) if line.strip()]
+
+def RecordPos(line):
+	"""Returns the POS of a VCF record, or UNPARSABLE_POS"""
+	fields = line.split('\t', 2)
 	try:
-		ret = int(splittedX[1]) - int(splittedY[1])
-        	return ret
-	except:
-		pass
-	
+		return int(fields[1])
+	except (IndexError, ValueError):
+		print "WARNING: Do not know how to sort these fields:", line.rstrip('\r\n')[:100]
+		return UNPARSABLE_POS
+
+def RecordKey(line, contigOrder):
+	"""Returns the (contig rank, POS) sort key of a VCF record"""
+	return contigOrder.Rank(line.split('\t', 1)[0]), RecordPos(line)
+
+def SortVCFLines(lines, contigOrder):
+	"""
+	Sorts VCF records on (contig rank, POS, original index). The key is computed once
+	per record and sorted() is stable, which provides the original index tie break.
+	"""
+	return sorted(lines, key=lambda line: RecordKey(line, contigOrder))
+
+def SortContigBucket(lines):
+	"""Sorts the records of a single contig on (POS, original index). Runs in a worker process."""
+	return sorted(lines, key=RecordPos)
+
+def ParallelSortVCFLines(lines, output, contigOrder, threads):
+	"""
+	Partitions the records by contig in one pass and sorts the contigs in a pool of
+	threads processes. The sorted contigs are written in contig rank order.
+	"""
+	buckets = {}
+	for line in lines:
+		rank = contigOrder.Rank(line.split('\t', 1)[0])
+		bucket = buckets.get(rank)
+		if bucket is None:
+			bucket = buckets[rank] = []
+		bucket.append(line)
+	print "..Partitioned the records into", len(buckets), "contigs"
+
+	pool = multiprocessing.Pool(threads)
 	try:
-		a = int(splittedX[1])
-	except:
-		print "WARNING: Do not know how to sort these fields:", splittedX[1]
-		return 1
-	
+		#Start with the largest contigs so the pool stays busy
+		results = {}
+		for rank in sorted(buckets, key=lambda rank: len(buckets[rank]), reverse=True):
+			results[rank] = pool.apply_async(SortContigBucket, (buckets[rank],))
+		for rank in sorted(buckets):
+			output.writelines(results.pop(rank).get())
+			del buckets[rank]
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+def WriteRun(lines, tmpDir):
+	"""Writes a sorted run to a temporary file and returns its filename"""
+	runFd, runFilename = tempfile.mkstemp(prefix='SortVCFFilename.', suffix='.run', dir=tmpDir)
+	runFile = os.fdopen(runFd, 'w')
+	runFile.writelines(lines)
+	runFile.close()
+	return runFilename
+
+def MergeRuns(runFilenames, output, contigOrder):
+	"""
+	k-way merges sorted runs into output. Ties are broken on the run index, and
+	runs hold consecutive parts of the input, so the merge is as stable as sorted()
+	"""
+	def Decorate(runIndex, runFile):
+		for line in runFile:
+			rank, pos = RecordKey(line, contigOrder)
+			yield rank, pos, runIndex, line
+
+	runFiles = [open(runFilename) for runFilename in runFilenames]
 	try:
-		a = int(splittedY[1])
-	except:
-		print "WARNING: Do not know how to sort these fields:", splittedY[1]
-		return -1
+		for _, _, _, line in heapq.merge(*[Decorate(runIndex, runFile) for runIndex, runFile in enumerate(runFiles)]):
+			output.write(line)
+	finally:
+		for runFile in runFiles: runFile.close()
 
+def ExternalSortVCFLines(lines, output, contigOrder, maxMemory, tmpDir=None):
+	"""
+	Sorts VCF records with at most maxMemory bytes of records in memory.
+	Bounded-size runs are sorted in memory and spilled to temporary files in tmpDir,
+	which are then k-way merged into output.
+	"""
+	runFilenames = []
+	try:
+		run = []
+		runSize = 0
+		for line in lines:
+			run.append(line)
+			#Account for the string object and the list slot, not only the text
+			runSize += sys.getsizeof(line) + 8
+			if runSize >= maxMemory:
+				runFilenames.append(WriteRun(SortVCFLines(run, contigOrder), tmpDir))
+				print "..Spilled run", len(runFilenames), "with", len(run), "records"
+				run = []
+				runSize = 0
 
-	
+		if not runFilenames:
+			#Everything fitted in memory
+			output.writelines(SortVCFLines(run, contigOrder))
+			return
+		if run:
+			runFilenames.append(WriteRun(SortVCFLines(run, contigOrder), tmpDir))
+			print "..Spilled run", len(runFilenames), "with", len(run), "records"
+		del run
 
-def SortVCFFilename(inputFilename, outputFilename):
+		while len(runFilenames) > MAX_MERGE_FANIN:
+			mergeFd, mergeFilename = tempfile.mkstemp(prefix='SortVCFFilename.', suffix='.run', dir=tmpDir)
+			mergeFile = os.fdopen(mergeFd, 'w')
+			MergeRuns(runFilenames[:MAX_MERGE_FANIN], mergeFile, contigOrder)
+			mergeFile.close()
+			for runFilename in runFilenames[:MAX_MERGE_FANIN]: DeleteFilename(runFilename)
+			#The merged run replaces the first runs, so runs stay in input order for stability
+			runFilenames = [mergeFilename] + runFilenames[MAX_MERGE_FANIN:]
 
-        print "Removing the header.."
-        command = 'cat ' + inputFilename + ' | grep -v "#"  > ' + outputFilename + '.toSort'
-        print command
-        os.system(command)
+		print "..Merging", len(runFilenames), "runs"
+		MergeRuns(runFilenames, output, contigOrder)
+	finally:
+		for runFilename in runFilenames:
+			if os.path.exists(runFilename): DeleteFilename(runFilename)
 
-        command = 'cat ' + inputFilename + ' | grep "#"  > ' + outputFilename + '.header'
-        print command
-        os.system(command)
-        print "..Done"
+def OpenVCF(filename):
+	"""Opens a plain, gzip or BGZF compressed VCF for reading"""
+	fileInput = open(filename, 'rb')
+	if fileInput.read(2) != GZIP_MAGIC:
+		fileInput.seek(0)
+		return fileInput
+	fileInput.close()
+	#GzipFile reads BGZF as multi-member gzip; the buffered reader makes iterating lines fast
+	return io.BufferedReader(gzip.open(filename, 'rb'), buffer_size=READ_BUFFER_SIZE)
 
-        print "Loading.."
-        filelines = open(outputFilename + '.toSort').readlines()
-        print "..Done"
+def IsCompressed(filename):
+	fileInput = open(filename, 'rb')
+	magic = fileInput.read(2)
+	fileInput.close()
+	return magic == GZIP_MAGIC
+
+def IsBgzf(filename):
+	"""Checks for a gzip header with the BGZF 'BC' extra subfield"""
+	fileInput = open(filename, 'rb')
+	header = fileInput.read(18)
+	fileInput.close()
+	return header[:4] == '\x1f\x8b\x08\x04' and header[12:14] == 'BC'
+
+class BgzfWriter(object):
+	"""
+	Writes BGZF (http://samtools.github.io/hts-specs/SAMv1.pdf): gzip blocks of at most
+	BGZF_BLOCK_SIZE uncompressed bytes, ending with the empty EOF block.
+	Tell() returns the virtual offset (block offset << 16 | offset in block) used by indices.
+	"""
+
+	def __init__(self, filename, level=6):
+		self.handle = open(filename, 'wb')
+		self.level = level
+		self.block = []
+		self.blockSize = 0
+		self.blockOffset = 0
+
+	def Tell(self):
+		return (self.blockOffset << 16) | self.blockSize
+
+	def write(self, data):
+		while data:
+			room = BGZF_BLOCK_SIZE - self.blockSize
+			self.block.append(data[:room])
+			self.blockSize += min(room, len(data))
+			data = data[room:]
+			if self.blockSize == BGZF_BLOCK_SIZE:
+				self.FlushBlock()
+
+	def writelines(self, lines):
+		for line in lines: self.write(line)
+
+	def FlushBlock(self):
+		data = ''.join(self.block)
+		compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+		compressed = compressor.compress(data) + compressor.flush()
+		#BSIZE is the total block size minus 1: 18 header bytes, the deflated data and 8 footer bytes
+		header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25)
+		footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+		self.handle.write(header + compressed + footer)
+		self.blockOffset += len(header) + len(compressed) + len(footer)
+		self.block = []
+		self.blockSize = 0
+
+	def close(self):
+		if self.blockSize:
+			self.FlushBlock()
+		self.handle.write(BGZF_EOF)
+		self.handle.close()
+
+def Reg2Bin(beg, end, minShift, depth):
+	"""UCSC bin of the 0-based, half-open interval [beg, end), as in htslib's hts_reg2bin"""
+	end -= 1
+	shift = minShift
+	first = ((1 << (depth * 3)) - 1) // 7
+	for level in range(depth, 0, -1):
+		if beg >> shift == end >> shift:
+			return first + (beg >> shift)
+		shift += 3
+		first -= 1 << ((level - 1) * 3)
+	return 0
+
+def BinFirstWindow(bin, depth):
+	"""Returns the first linear index window of a bin, as in htslib's hts_bin_bot"""
+	level = 0
+	parent = bin
+	while parent:
+		parent = (parent - 1) >> 3
+		level += 1
+	return (bin - ((1 << (level * 3)) - 1) // 7) << ((depth - level) * 3)
+
+class VCFIndexer(object):
+	"""
+	Builds a tabix (.tbi) or CSI (.csi) index of a sorted BGZF VCF while it is written,
+	following htslib: chunks per bin, a linear index of 16kb windows and a pseudo-bin
+	with the offsets and record count of each contig.
+	"""
+
+	def __init__(self, indexFormat):
+		self.indexFormat = indexFormat
+		self.depth = TBI_DEPTH if indexFormat == 'tbi' else CSI_DEPTH
+		self.metaBin = ((1 << ((self.depth + 1) * 3)) - 1) // 7 + 1
+		self.contigs = []
+		self.references = []
+		self.previous = None
+
+	def Add(self, line, start, end):
+		"""Adds the record line written between virtual offsets start and end"""
+		fields = line.split('\t', 8)
+		try:
+			beg = int(fields[1]) - 1
+			stop = beg + len(fields[3])
+		except (IndexError, ValueError):
+			raise SortVCFError("can not index the record: " + line.rstrip('\r\n')[:100])
+		if len(fields) > 7:
+			for info in fields[7].split(';'):
+				if info.startswith('END='):
+					try:
+						stop = max(stop, int(info[len('END='):]))
+					except ValueError:
+						pass
+					break
+		stop = max(stop, beg + 1)
+
+		contig = fields[0]
+		if self.previous is None or self.previous[0] != contig:
+			if contig in self.contigs:
+				raise SortVCFError("can not index, the records of contig " + contig + " are not together")
+			self.FinishReference()
+			self.contigs.append(contig)
+			self.references.append({'bins': {}, 'linear': [], 'first': start, 'last': end, 'records': 0})
+			self.bin = None
+		elif beg < self.previous[1]:
+			raise SortVCFError("can not index, the records are not sorted at: " + line.rstrip('\r\n')[:100])
+		self.previous = (contig, beg)
+
+		reference = self.references[-1]
+		bin = Reg2Bin(beg, stop, INDEX_MIN_SHIFT, self.depth)
+		if bin != self.bin:
+			self.FinishChunk()
+			self.bin = bin
+			self.chunkStart = start
+		self.chunkEnd = end
+
+		linear = reference['linear']
+		lastWindow = (stop - 1) >> INDEX_MIN_SHIFT
+		if len(linear) <= lastWindow:
+			linear.extend([None] * (lastWindow + 1 - len(linear)))
+		for window in xrange(beg >> INDEX_MIN_SHIFT, lastWindow + 1):
+			if linear[window] is None:
+				linear[window] = start
+
+		reference['last'] = end
+		reference['records'] += 1
+
+	def MoveLastEnd(self, end):
+		"""Sets the end offset of the last record, once its block is flushed"""
+		if self.references:
+			self.references[-1]['last'] = end
+			self.chunkEnd = end
+
+	def FinishChunk(self):
+		if self.bin is not None:
+			self.references[-1]['bins'].setdefault(self.bin, []).append([self.chunkStart, self.chunkEnd])
+
+	def FinishReference(self):
+		"""Fills the empty linear index windows and compacts the bins like htslib's hts_idx_finish"""
+		if not self.references:
+			return
+		self.FinishChunk()
+		self.bin = None
+		reference = self.references[-1]
+
+		#Windows that no record overlaps get the offset of the next window
+		linear = reference['linear']
+		for window in xrange(len(linear) - 2, -1, -1):
+			if linear[window] is None:
+				linear[window] = linear[window + 1]
+
+		#Bins spanning less than one BGZF block distance are moved into their parent bin
+		bins = reference['bins']
+		for level in range(self.depth, 0, -1):
+			first = ((1 << (level * 3)) - 1) // 7
+			for bin in sorted([bin for bin in bins if bin >= first]):
+				chunks = bins[bin]
+				chunks.sort()
+				parent = (bin - 1) >> 3
+				if (chunks[-1][1] >> 16) - (chunks[0][0] >> 16) < 0x10000 and parent in bins:
+					bins[parent].extend(chunks)
+					del bins[bin]
+
+		#Chunks that meet in the same BGZF block are merged
+		for bin in bins:
+			chunks = sorted(bins[bin])
+			merged = [chunks[0]]
+			for chunkStart, chunkEnd in chunks[1:]:
+				if merged[-1][1] >> 16 >= chunkStart >> 16:
+					merged[-1][1] = max(merged[-1][1], chunkEnd)
+				else:
+					merged.append([chunkStart, chunkEnd])
+			bins[bin] = merged
+
+	def Write(self, indexFilename):
+		self.FinishReference()
+		names = ''.join([contig + '\0' for contig in self.contigs])
+		#Tabix configuration: VCF format, sequence in column 1, begin in column 2, no end column, '#' meta lines
+		config = struct.pack('<6i', 2, 1, 2, 0, ord('#'), 0) + struct.pack('<i', len(names)) + names
+		if self.indexFormat == 'tbi':
+			data = ['TBI\1', struct.pack('<i', len(self.contigs)), config]
+		else:
+			data = ['CSI\1', struct.pack('<3i', INDEX_MIN_SHIFT, self.depth, len(config)), config, struct.pack('<i', len(self.contigs))]
+
+		for reference in self.references:
+			bins = reference['bins']
+			data.append(struct.pack('<i', len(bins) + 1))
+			for bin in sorted(bins):
+				if self.indexFormat == 'tbi':
+					data.append(struct.pack('<Ii', bin, len(bins[bin])))
+				else:
+					window = BinFirstWindow(bin, self.depth)
+					loffset = reference['linear'][window] if window < len(reference['linear']) else 0
+					data.append(struct.pack('<IQi', bin, loffset, len(bins[bin])))
+				for chunkStart, chunkEnd in bins[bin]:
+					data.append(struct.pack('<QQ', chunkStart, chunkEnd))
+			if self.indexFormat == 'tbi':
+				data.append(struct.pack('<Ii', self.metaBin, 2))
+			else:
+				data.append(struct.pack('<IQi', self.metaBin, 0, 2))
+			data.append(struct.pack('<QQQQ', reference['first'], reference['last'], reference['records'], 0))
+			if self.indexFormat == 'tbi':
+				data.append(struct.pack('<i', len(reference['linear'])))
+				data.append(struct.pack('<%dQ' % len(reference['linear']), *reference['linear']))
+		#Number of records without coordinates
+		data.append(struct.pack('<Q', 0))
+
+		indexFile = BgzfWriter(indexFilename)
+		indexFile.write(''.join(data))
+		indexFile.close()
+
+class IndexingVCFWriter(object):
+	"""Writes a VCF to BGZF and builds its tabix or CSI index in the same pass"""
+
+	def __init__(self, outputFilename, indexFormat):
+		self.output = BgzfWriter(outputFilename)
+		self.indexer = VCFIndexer(indexFormat)
+		self.indexFilename = outputFilename + '.' + indexFormat
+
+	def write(self, line):
+		if line.startswith('#'):
+			self.output.write(line)
+			return
+		start = self.output.Tell()
+		self.output.write(line)
+		self.indexer.Add(line, start, self.output.Tell())
+
+	def writelines(self, lines):
+		for line in lines: self.write(line)
+
+	def close(self):
+		#As in htslib, the last record ends at the start of the EOF block rather than at the end of its block
+		if self.output.blockSize:
+			self.output.FlushBlock()
+			self.indexer.MoveLastEnd(self.output.Tell())
+		self.output.close()
+		self.indexer.Write(self.indexFilename)
+
+def OpenVCFOutput(outputFilename, bgzf=False, indexFormat=None):
+	"""Opens outputFilename for writing as plain text, BGZF, or BGZF with a .tbi/.csi index"""
+	if indexFormat is not None:
+		return IndexingVCFWriter(outputFilename, indexFormat)
+	if bgzf:
+		return BgzfWriter(outputFilename)
+	return open(outputFilename, "w")
+
+def ReadVCF(inputFile):
+	"""
+	Reads the header lines (the leading lines that start with '#') of an open VCF.
+	Returns them together with an iterator over the remaining records, so the file is read once.
+	"""
+	headerLines = []
+	for line in inputFile:
+		if not line.startswith('#'):
+			return headerLines, Records(itertools.chain([line], inputFile))
+		headerLines.append(line)
+	return headerLines, iter([])
+
+def Records(lines):
+	"""Skips blank lines and terminates the last record if the file lacks a final newline"""
+	for line in lines:
+		if not line.endswith('\n'):
+			line += '\n'
+		if line.strip():
+			yield line
+
+def IndexOrder(ranks, positions):
+	"""
+	Returns the record indices in (contig rank, POS, original index) order. With NumPy this
+	is a stable lexsort on the arrays, otherwise a stable sort of the indices.
+	"""
+	if numpy is not None and len(ranks) > 0:
+		return numpy.lexsort((numpy.frombuffer(positions, dtype=numpy.uint32), numpy.frombuffer(ranks, dtype=numpy.uint32)))
+	return sorted(xrange(len(ranks)), key=lambda index: (ranks[index], positions[index]))
+
+def IndexSortVCFFilename(inputFilename, outputFilename, faiFilename=None, bgzf=False, indexFormat=None):
+        """
+        Sorts inputFilename into outputFilename without holding the records in memory.
+        A scan keeps only the contig rank, POS, byte offset and length of each record in
+        compact arrays (20 bytes per record). These are sorted and the records are copied
+        to the output through an mmap of the input.
+        Contigs are ordered as in faiFilename if given, otherwise as in the ##contig header lines.
+        The input must be uncompressed, the output can be BGZF with a .tbi or .csi index.
+        """
+
+        if IsCompressed(inputFilename):
+                raise SortVCFError(inputFilename + " is compressed, --index-sort needs an uncompressed VCF")
+
+        ranks = array('I')
+        positions = array('I')
+        offsets = array('l')
+        lengths = array('I')
+
+        fileInput = open(inputFilename, 'rb')
+        print "Indexing the records.."
+        headerLines = []
+        contigOrder = None
+        offset = 0
+        for line in fileInput:
+                if contigOrder is None:
+                        if line.startswith('#'):
+                                headerLines.append(line)
+                                offset += len(line)
+                                continue
+                        if faiFilename is not None:
+                                contigOrder = ContigOrder(ReadContigsFromFai(faiFilename))
+                        else:
+                                contigOrder = ContigOrder(ReadContigsFromHeader(headerLines))
+                if line.strip():
+                        rank, pos = RecordKey(line, contigOrder)
+                        ranks.append(rank)
+                        positions.append(pos)
+                        offsets.append(offset)
+                        lengths.append(len(line))
+                offset += len(line)
+        print "..Done,", len(offsets), "records"
 
         print "Sorting.."
-        fileLinesSorted = sorted(filelines, sortFunction)
+        order = IndexOrder(ranks, positions)
+        del ranks, positions
         print "..Done"
 
         print "Outputing..."
-        fileOutput = open(outputFilename + '.sorted', "w")
-        for line in fileLinesSorted: fileOutput.write(line)
+        fileOutput = OpenVCFOutput(outputFilename, bgzf, indexFormat)
+        fileOutput.writelines(headerLines)
+        if len(offsets) > 0:
+                inputMap = mmap.mmap(fileInput.fileno(), 0, access=mmap.ACCESS_READ)
+                for index in order:
+                        start = offsets[index]
+                        record = inputMap[start:start + lengths[index]]
+                        if not record.endswith('\n'):
+                                record += '\n'
+                        fileOutput.write(record)
+                inputMap.close()
         fileOutput.close()
+        fileInput.close()
+        print "..Done"
+
+def CheckedRecords(inputIndex, inputFilename, records, contigOrder):
+	"""
+	Yields (contig rank, POS, inputIndex, record) for sorted records, raising a
+	SortVCFError at the first unsorted one
+	"""
+	previousKey = None
+	for recordNumber, line in enumerate(records, 1):
+		key = RecordKey(line, contigOrder)
+		if previousKey is not None and key < previousKey:
+			raise SortVCFError(inputFilename + " is not sorted at record " + str(recordNumber) + ": " + line.rstrip('\r\n')[:100])
+		previousKey = key
+		yield key[0], key[1], inputIndex, line
+
+def MergeVCFFilenames(inputFilenames, outputFilename, faiFilename=None, bgzf=False, indexFormat=None):
+        """
+        Merges already sorted VCF files with the same samples into outputFilename with a
+        streaming heap merge, holding one record per input in memory. Records with equal
+        positions are written in the order of inputFilenames.
+        Contigs are ordered as in faiFilename if given, otherwise as in the ##contig header lines
+        (see MergeContigs). The header of the first input is written, with the ##contig lines of
+        all inputs. Raises a SortVCFError on incompatible or unsorted inputs.
+        Inputs can be plain, gzip or BGZF, the output can be BGZF with a .tbi or .csi index.
+        """
+
+        fileInputs = [OpenVCF(inputFilename) for inputFilename in inputFilenames]
+        try:
+                print "Reading the headers.."
+                headers = [ReadVCF(fileInput) for fileInput in fileInputs]
+                print "..Done"
+
+                columns = [[line for line in headerLines if line.startswith('#CHROM')] for headerLines, _ in headers]
+                for inputFilename, inputColumns in zip(inputFilenames[1:], columns[1:]):
+                        if inputColumns != columns[0]:
+                                raise SortVCFError(inputFilename + " has other columns or samples than " + inputFilenames[0])
+
+                contigOrder, contigLines = MergeContigs(headers, faiFilename)
+
+                fileOutput = OpenVCFOutput(outputFilename, bgzf, indexFormat)
+                try:
+                        fileOutput.writelines(ReplaceContigLines(headers[0][0], contigLines))
+
+                        print "Merging", len(inputFilenames), "files.."
+                        checkedInputs = [CheckedRecords(inputIndex, inputFilename, records, contigOrder)
+                                for inputIndex, (inputFilename, (_, records)) in enumerate(zip(inputFilenames, headers))]
+                        for _, _, _, line in heapq.merge(*checkedInputs):
+                                fileOutput.write(line)
+                        print "..Done"
+                finally:
+                        fileOutput.close()
+        except SortVCFError:
+                for filename in [outputFilename, outputFilename + '.' + str(indexFormat)]:
+                        if os.path.exists(filename): DeleteFilename(filename)
+                raise
+        finally:
+                for fileInput in fileInputs: fileInput.close()
+
+def CheckVCFFilename(inputFilename, faiFilename=None):
+	"""
+	Checks in one streaming pass with O(1) memory that inputFilename is sorted.
+	Raises a SortVCFError at the first out-of-order record.
+	"""
+	fileInput = OpenVCF(inputFilename)
+	try:
+		headerLines, records = ReadVCF(fileInput)
+		if faiFilename is not None:
+			contigOrder = ContigOrder(ReadContigsFromFai(faiFilename))
+		else:
+			contigOrder = ContigOrder(ReadContigsFromHeader(headerLines))
+		for _ in CheckedRecords(0, inputFilename, records, contigOrder): pass
+	finally:
+		fileInput.close()
+
+def CanCopyThrough(inputFilename, bgzf=False, indexFormat=None):
+	"""Returns whether a sorted inputFilename already has the requested output format"""
+	if indexFormat is not None:
+		return False
+	if bgzf:
+		return IsBgzf(inputFilename)
+	return not IsCompressed(inputFilename)
+
+def CopyVCFFilename(inputFilename, outputFilename, hardlink=False):
+	"""Copies or hardlinks an already sorted inputFilename to outputFilename"""
+	if os.path.abspath(inputFilename) == os.path.abspath(outputFilename):
+		return
+	if os.path.exists(outputFilename):
+		DeleteFilename(outputFilename)
+	if hardlink:
+		try:
+			os.link(inputFilename, outputFilename)
+			return
+		except OSError as error:
+			print "Can not hardlink (" + str(error) + "), copying instead"
+	shutil.copyfile(inputFilename, outputFilename)
+
+def SortVCFFilename(inputFilename, outputFilename, maxMemory=None, tmpDir=None, faiFilename=None, threads=1, bgzf=False, indexFormat=None):
+        """
+        Sorts inputFilename into outputFilename in a single pass over the input.
+        If maxMemory (in bytes) is given the records are sorted externally in runs of at most
+        maxMemory bytes, spilled to tmpDir (default: the directory of outputFilename).
+        Otherwise, with threads > 1 the contigs are sorted in parallel processes.
+        Contigs are ordered as in faiFilename if given, otherwise as in the ##contig header lines.
+        The input can be plain, gzip or BGZF. With bgzf the output is BGZF, and with
+        indexFormat 'tbi' or 'csi' its index is built while it is written.
+        """
+
+        fileInput = OpenVCF(inputFilename)
+        print "Reading the header.."
+        headerLines, records = ReadVCF(fileInput)
         print "..Done"
 
-        command = 'cat ' + outputFilename + '.header' + ' ' + outputFilename + '.sorted > ' + outputFilename
-        print command
-        os.system(command)
+        if faiFilename is not None:
+                contigOrder = ContigOrder(ReadContigsFromFai(faiFilename))
+        else:
+                contigOrder = ContigOrder(ReadContigsFromHeader(headerLines))
+
+        fileOutput = OpenVCFOutput(outputFilename, bgzf, indexFormat)
+        fileOutput.writelines(headerLines)
+
+        if maxMemory is None and threads > 1:
+                print "Sorting the contigs in", threads, "processes.."
+                ParallelSortVCFLines(records, fileOutput, contigOrder, threads)
+                print "..Done"
+        elif maxMemory is None:
+                print "Loading.."
+                filelines = list(records)
+                print "..Done"
 
-        DeleteFilename(outputFilename + '.header')
-        DeleteFilename(outputFilename + '.toSort')
-        DeleteFilename(outputFilename + '.sorted')
+                print "Sorting.."
+                fileLinesSorted = SortVCFLines(filelines, contigOrder)
+                del filelines
+                print "..Done"
+
+                print "Outputing..."
+                fileOutput.writelines(fileLinesSorted)
+                print "..Done"
+        else:
+                if tmpDir is None: tmpDir = os.path.dirname(os.path.abspath(outputFilename))
+
+                print "Sorting externally in runs of at most", maxMemory, "bytes in", tmpDir, ".."
+                ExternalSortVCFLines(records, fileOutput, contigOrder, maxMemory, tmpDir)
+                print "..Done"
+
+        fileOutput.close()
+        fileInput.close()
 
 if __name__ == "__main__":
-	SortVCFFilename(sys.argv[1], sys.argv[2])
+	parser = optparse.OptionParser(usage='usage: %prog [options] <inputVCFFilename.vcf> <outputVCFFilename>\n' +
+		'       %prog --merge [options] <sortedVCFFilename1.vcf> .. <sortedVCFFilenameN.vcf> <outputVCFFilename>\n' +
+		'       %prog --check [options] <inputVCFFilename.vcf>')
+	parser.add_option('-c', '--check', action='store_true', default=False, help='only check whether the input is sorted and report the first out-of-order record')
+	parser.add_option('-M', '--merge', action='store_true', default=False, help='merge already sorted VCF files with the same samples instead of sorting one file')
+	parser.add_option('-m', '--max-memory', type='int', metavar='MB', help='external sort: keep at most MB megabytes of records in memory, spilling sorted runs to temporary files [default: sort everything in memory]')
+	parser.add_option('-f', '--fai', metavar='FILE', help='reference .fai whose contig order is used [default: order of the ##contig header lines, or 1..22, X, Y, MT]')
+	parser.add_option('-i', '--index-sort', action='store_true', default=False, help='keep only the position, offset and length of each record in memory and copy the records through an mmap of the input')
+	parser.add_option('-t', '--threads', type='int', default=1, metavar='N', help='sort the contigs in N parallel processes [default: 1]')
+	parser.add_option('-b', '--bgzf', action='store_true', default=False, help='write BGZF compressed output')
+	parser.add_option('-x', '--index', choices=['tbi', 'csi'], metavar='tbi|csi', help='write a tabix .tbi or .csi index of the BGZF output, built while it is written')
+	parser.add_option('-n', '--no-fast-path', action='store_true', default=False, help='always sort, also when the input is already sorted')
+	parser.add_option('-l', '--hardlink', action='store_true', default=False, help='hardlink instead of copy an input that is already sorted')
+	parser.add_option('-T', '--tmp-dir', metavar='DIR', help='directory for the temporary runs of the external sort [default: directory of the output file]')
+	(options, args) = parser.parse_args()
+	if (options.check and len(args) != 1) or (not options.check and len(args) < 2) or (len(args) > 2 and not options.merge):
+		parser.print_help()
+		sys.exit(1)
+	if options.max_memory is not None and options.max_memory <= 0:
+		parser.error('--max-memory must be a positive number of megabytes')
+	if options.threads < 1:
+		parser.error('--threads must be at least 1')
+	if options.threads > 1 and options.max_memory is not None:
+		parser.error('--threads and --max-memory can not be combined')
+	if options.merge and (options.threads > 1 or options.max_memory is not None):
+		parser.error('--merge streams the inputs and takes no --threads or --max-memory')
+	if options.index is not None and not options.bgzf:
+		parser.error('--index needs --bgzf output')
+	if options.index_sort and (options.merge or options.threads > 1 or options.max_memory is not None):
+		parser.error('--index-sort can not be combined with --merge, --threads or --max-memory')
+
+	maxMemory = None if options.max_memory is None else options.max_memory * 1024 * 1024
+	try:
+		if options.check:
+			CheckVCFFilename(args[0], options.fai)
+			print args[0], "is sorted"
+			sys.exit(0)
+
+		if not options.merge and not options.no_fast_path and CanCopyThrough(args[0], options.bgzf, options.index):
+			print "Checking whether the input is already sorted.."
+			try:
+				CheckVCFFilename(args[0], options.fai)
+				print "..Sorted, copying it through"
+				CopyVCFFilename(args[0], args[1], options.hardlink)
+				sys.exit(0)
+			except SortVCFError as error:
+				print "..Not sorted:", error
+
+		if options.merge:
+			MergeVCFFilenames(args[:-1], args[-1], options.fai, options.bgzf, options.index)
+		elif options.index_sort:
+			IndexSortVCFFilename(args[0], args[1], options.fai, options.bgzf, options.index)
+		else:
+			SortVCFFilename(args[0], args[1], maxMemory, options.tmp_dir, options.fai, options.threads, options.bgzf, options.index)
+	except SortVCFError as error:
+		sys.exit("ERROR: " + str(error))
@@ -4,6 +4,28 @@ I hacked this script so that it does not add an eof marker, but
 only checks if it is present or not.
 Usage: python bam_check_for_eof.py bamfile.bam [bamfile2.bam ... bamfileN.bam]
 wbkoetsier 20120912
+
+For archive audits, batch mode recurses into directories, checks the files
+in a thread pool, continues past bad files and writes a TSV or JSON report:
+python bam_check_for_eof.py --batch --jobs 32 --report audit.tsv /archive/project1 /archive/project2
+
+The EOF check only looks at the first and last bytes. --deep walks the whole
+chain of BGZF blocks (with --inflate also verifying each block's CRC32), split
+across --processes for large files, and reports the first bad block:
+python bam_check_for_eof.py --deep --inflate --processes 8 bamfile.bam
+
+For nightly sweeps, --cache keeps the results in SQLite, so files with the same
+size, mtime and inode are only stat()ed on later runs:
+python bam_check_for_eof.py --batch --deep --cache sweep.sqlite --recheck-older-than 30 /archive
+
+--index adds the .bai/.csi files to the same sweep: missing, bad magic, older
+than the BAM, or pointing past its end:
+python bam_check_for_eof.py --batch --index --report preflight.tsv /data/run42
+
+For a truncated file, --salvage reports the last complete block and the number
+of complete BAM records before it, and --repair-dir writes a copy cut there
+with an EOF block, leaving the original alone:
+python bam_check_for_eof.py --salvage --repair-dir /scratch/repaired bamfile.bam
 """
 
 """Python script to add missing EOF marker to BAM or BGZF files.
@@ -40,39 +62,726 @@ https://github.com/peterjc/picobio/blob/master/sambam/bgzf_add_eof.py at 2012091
 
 import os
 import sys
+import json
+import time
+import mmap
+import zlib
+import struct
+import sqlite3
+import optparse
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+BGZF_HEADER = "\x1f\x8b\x08\x04\x00\x00\x00\x00" + \
+              "\x00\xff\x06\x00\x42\x43\x02\x00"
+BGZF_EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC" + \
+           "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+BGZF_MAGIC = "\x1f\x8b\x08\x04"
+#XLEN of 6 followed by the BC subfield header, at offset 10 of a block
+BGZF_BSIZE_FIELD = "\x06\x00BC\x02\x00"
+#Deep checks of larger files are split across processes in ranges of at least this size
+MIN_SEGMENT_SIZE = 64 * 1024 * 1024
+
+REPORT_FIELDS = ["path", "status", "size", "seconds", "blocks", "bad_offset", "cached", "message",
+                 "index", "index_status", "index_message"]
+#Bin number of the pseudo-bin with mapped/unmapped counts in a BAI index
+BAI_PSEUDO_BIN = 37450
+#Cached results of a check mode also satisfy the weaker modes
+CHECK_MODES = ["eof", "deep", "inflate"]
+#Size of the fixed part of a BAM record, after its block_size
+MIN_RECORD_SIZE = 32
 
 def sys_exit(msg, return_code=1):
     sys.stderr.write(msg.rstrip() + "\n")
     sys.exit(return_code)
 
-def fix_bam(filename):
-    header = "\x1f\x8b\x08\x04\x00\x00\x00\x00" + \
-             "\x00\xff\x06\x00\x42\x43\x02\x00"
-    eof = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC" + \
-          "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
-    if not os.path.isfile(filename):
-        sys_exit("Missing file %s" % filename)
+def block_end(data, offset):
+    """Returns (offset after the BGZF block at offset, error) from its BSIZE field"""
+    if offset + 18 > len(data):
+        return None, "truncated block header"
+    if data[offset:offset + 4] != BGZF_MAGIC:
+        return None, "no BGZF magic"
+    xlen = struct.unpack_from("<H", data, offset + 10)[0]
+    bsize = None
+    extra = offset + 12
+    while extra + 4 <= offset + 12 + xlen:
+        slen = struct.unpack_from("<H", data, extra + 2)[0]
+        if data[extra:extra + 2] == "BC" and slen == 2:
+            bsize = struct.unpack_from("<H", data, extra + 4)[0]
+        extra += 4 + slen
+    if bsize is None:
+        return None, "no BSIZE field"
+    end = offset + bsize + 1
+    if end > len(data):
+        return None, "block extends past the end of the file"
+    return end, None
+
+def inflate_block(data, offset, end):
+    """Returns (inflated data, error) of the BGZF block from offset to end, verifying CRC32 and ISIZE"""
+    xlen = struct.unpack_from("<H", data, offset + 10)[0]
+    crc, isize = struct.unpack_from("<II", data, end - 8)
+    try:
+        block = zlib.decompress(data[offset + 12 + xlen:end - 8], -15)
+    except zlib.error as e:
+        return None, "can not inflate block: %s" % e
+    if len(block) != isize:
+        return None, "ISIZE %i does not match %i inflated bytes" % (isize, len(block))
+    if zlib.crc32(block) & 0xffffffff != crc:
+        return None, "CRC32 mismatch"
+    return block, None
+
+def walk_blocks(data, start, stop, inflate=False):
+    """Follows the BSIZE chain of BGZF blocks in data from start until stop.
+
+    With inflate each block is decompressed and its CRC32 and ISIZE are
+    verified. Returns (offset reached, number of blocks, error), where the
+    offset is that of the first bad block if error is not None.
+    """
+    offset = start
+    blocks = 0
+    while offset < stop:
+        end, error = block_end(data, offset)
+        if error is None and inflate:
+            error = inflate_block(data, offset, end)[1]
+        if error:
+            return offset, blocks, error
+        blocks += 1
+        offset = end
+    return offset, blocks, None
+
+def walk_range(args):
+    """Walks the blocks of a file range in a worker process; args is (filename, start, stop, inflate)"""
+    filename, start, stop, inflate = args
+    h = open(filename, "rb")
+    data = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return (start,) + walk_blocks(data, start, stop, inflate)
+    finally:
+        data.close()
+        h.close()
+
+def find_block_start(data, offset):
+    """Returns the offset of the first likely BGZF block header at or after offset"""
+    while True:
+        offset = data.find(BGZF_BSIZE_FIELD, offset + 10)
+        if offset == -1:
+            return len(data)
+        offset -= 10
+        if data[offset:offset + 4] == BGZF_MAGIC:
+            return offset
+        offset += 11
+
+def deep_check(filename, size, inflate=False, pool=None, processes=1):
+    """Walks every BGZF block of a file through mmap.
+
+    Files of at least two MIN_SEGMENT_SIZE ranges are split at likely block
+    headers and walked by the processes of pool. A range that does not start
+    where the chain of the previous one ended was split inside compressed data,
+    and the file is walked serially from there. Returns (blocks, bad offset, error).
+    """
+    h = open(filename, "rb")
+    data = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        segments = 1
+        if pool is not None:
+            segments = min(processes, size // MIN_SEGMENT_SIZE)
+        starts = [0]
+        for segment in range(1, segments):
+            start = find_block_start(data, size * segment // segments)
+            if start > starts[-1] and start < size:
+                starts.append(start)
+
+        if len(starts) == 1:
+            offset, blocks, error = walk_blocks(data, 0, size, inflate)
+            return blocks, offset if error else None, error
+
+        ranges = [(filename, start, stop, inflate) for start, stop in zip(starts, starts[1:] + [size])]
+        total = 0
+        expected = 0
+        for start, offset, blocks, error in pool.map(walk_range, ranges):
+            if start != expected:
+                offset, blocks, error = walk_blocks(data, expected, size, inflate)
+                return total + blocks, offset if error else None, error
+            total += blocks
+            if error:
+                return total, offset, error
+            expected = offset
+        return total, None, None
+    finally:
+        data.close()
+        h.close()
+
+def check_bam(filename, deep=False, inflate=False, pool=None, processes=1):
+    """Checks the BGZF header and EOF block of one file without exiting.
+
+    With deep every block is walked as well (see deep_check), and a bad block
+    gives status corrupt. Returns a dict with the path, status (ok, no_eof,
+    corrupt, not_bam, missing or error), size in bytes, seconds spent, number
+    of blocks, offset of the first bad block and a message.
+    """
+    start = time.time()
+    result = {"path": filename, "status": "ok", "size": None, "message": "",
+              "blocks": None, "bad_offset": None}
+    try:
+        if not os.path.isfile(filename):
+            result["status"] = "missing"
+            result["message"] = "Missing file %s" % filename
+        else:
+            size = os.path.getsize(filename)
+            result["size"] = size
+            h = open(filename, "rb")
+            try:
+                #Check it looks like a BGZF file
+                #(could still be GZIP'd, in which case the extra block is harmless)
+                data = h.read(len(BGZF_HEADER))
+                if data != BGZF_HEADER:
+                    result["status"] = "not_bam"
+                    result["message"] = "File %s is not a BAM file" % filename
+                else:
+                    #Check if it has the EOF already
+                    h.seek(max(size - 28, 0))
+                    if h.read(28) == BGZF_EOF:
+                        result["message"] = "EOF present in %s" % filename
+                    else:
+                        result["status"] = "no_eof"
+                        result["message"] = "No EOF present in %s" % filename
+            finally:
+                h.close()
+            if deep and result["status"] != "not_bam":
+                blocks, bad_offset, error = deep_check(filename, size, inflate, pool, processes)
+                result["blocks"] = blocks
+                if error:
+                    result["status"] = "corrupt"
+                    result["bad_offset"] = bad_offset
+                    result["message"] = "Bad BGZF block at offset %i of %s after %i good blocks: %s" % \
+                                        (bad_offset, filename, blocks, error)
+    except (IOError, OSError) as e:
+        result["status"] = "error"
+        result["message"] = "Can not read %s: %s" % (filename, e)
+    result["seconds"] = round(time.time() - start, 6)
+    return result
+
+class BamStream(object):
+    """Counts the complete records in the inflated data of a BAM file, fed in blocks.
+
+    aligned is True while the data fed so far ends after the header or after
+    a complete record. state is not_bam if the data does not start with the
+    BAM magic, and damaged at a length that no header or record can have,
+    which ends the data worth salvaging.
+    """
+
+    def __init__(self):
+        self.pending = ""
+        self.pos = 0
+        self.state = "magic"
+        self.refs_left = 0
+        self.records = 0
+
+    def feed(self, block):
+        if self.state in ("not_bam", "damaged"):
+            return
+        self.pending = self.pending[self.pos:] + block
+        self.pos = 0
+        pending = self.pending
+        pos = 0
+        while True:
+            avail = len(pending) - pos
+            if self.state == "records":
+                if avail < 4:
+                    break
+                size = struct.unpack_from("<i", pending, pos)[0]
+                if size < MIN_RECORD_SIZE:
+                    self.state = "damaged"
+                    break
+                if avail < 4 + size:
+                    break
+                pos += 4 + size
+                self.records += 1
+            elif self.state == "magic":
+                if avail < 8:
+                    break
+                if pending[pos:pos + 4] != "BAM\x01":
+                    self.state = "not_bam"
+                    break
+                l_text = struct.unpack_from("<i", pending, pos + 4)[0]
+                if l_text < 0:
+                    self.state = "damaged"
+                    break
+                if avail < 12 + l_text:
+                    break
+                self.refs_left = struct.unpack_from("<i", pending, pos + 8 + l_text)[0]
+                if self.refs_left < 0:
+                    self.state = "damaged"
+                    break
+                pos += 12 + l_text
+                self.state = "refs"
+            elif self.state == "refs":
+                if self.refs_left == 0:
+                    self.state = "records"
+                    continue
+                if avail < 4:
+                    break
+                l_name = struct.unpack_from("<i", pending, pos)[0]
+                if l_name < 0:
+                    self.state = "damaged"
+                    break
+                if avail < 8 + l_name:
+                    break
+                pos += 8 + l_name
+                self.refs_left -= 1
+            else:
+                break
+        self.pos = pos
+
+    @property
+    def aligned(self):
+        return self.state == "records" and self.pos == len(self.pending)
+
+def salvage_bam(filename):
+    """Finds how much of a truncated or damaged BAM file can be kept.
+
+    Walks and inflates the blocks up to the first bad or truncated one (or
+    up to a header or record length that can not be right) and
+    counts the complete BAM records on the way. The cut offset is the end of
+    the last block that ends on a record boundary, so that the file up to it
+    plus an EOF block is a valid BAM file. For BGZF files that are not BAM it
+    is the end of the last complete block. Returns a dict.
+    """
     size = os.path.getsize(filename)
-    h = open(filename, "rb") #read only for now
-    #Check it looks like a BGZF file
-    #(could still be GZIP'd, in which case the extra block is harmless)
-    data = h.read(len(header))
-    if data != header:
-        sys_exit("File %s is not a BAM file" % filename)
-    #Check if it has the EOF already
-    h.seek(size - 28)
-    data = h.read(28)
-    h.close()
-    if data == eof:
-        sys.stderr.write("EOF present in %s\n" % filename)
+    result = {"path": filename, "size": size, "blocks": 0, "block_offset": 0, "bad_offset": None,
+              "error": None, "bam": True, "records": 0, "cut_offset": None}
+    h = open(filename, "rb")
+    data = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        stream = BamStream()
+        offset = 0
+        while offset < size:
+            end, error = block_end(data, offset)
+            if error is None:
+                block, error = inflate_block(data, offset, end)
+            if error:
+                result["bad_offset"] = offset
+                result["error"] = error
+                break
+            stream.feed(block)
+            if stream.state == "damaged":
+                result["bad_offset"] = offset
+                result["error"] = "a BAM header or record with an impossible length"
+                break
+            offset = end
+            result["blocks"] += 1
+            result["block_offset"] = end
+            #Empty blocks (like an EOF block) are not worth keeping at the end
+            if block and (stream.aligned or stream.state == "not_bam"):
+                result["cut_offset"] = end
+                result["records"] = stream.records
+        result["bam"] = stream.state != "not_bam"
+    finally:
+        data.close()
+        h.close()
+    return result
+
+def write_repaired(filename, cut_offset, repaired_filename):
+    """Copies filename up to cut_offset to repaired_filename and adds an EOF block"""
+    h = open(filename, "rb")
+    out = open(repaired_filename, "wb")
+    try:
+        left = cut_offset
+        while left > 0:
+            data = h.read(min(left, 16 * 1024 * 1024))
+            if not data:
+                raise IOError("%s is shorter than %i bytes" % (filename, cut_offset))
+            out.write(data)
+            left -= len(data)
+        out.write(BGZF_EOF)
+    finally:
+        out.close()
+        h.close()
+
+def report_salvage(filename, repair_dir=None):
+    """Prints the salvage analysis of filename, and writes a repaired copy into repair_dir"""
+    salvage = salvage_bam(filename)
+    if salvage["error"]:
+        sys.stderr.write("Salvage %s: %i complete blocks, the last one ends at offset %i of %i, then %s\n" %
+                         (filename, salvage["blocks"], salvage["block_offset"], salvage["size"], salvage["error"]))
+    else:
+        sys.stderr.write("Salvage %s: all %i blocks are complete, the last one ends at offset %i\n" %
+                         (filename, salvage["blocks"], salvage["block_offset"]))
+    if salvage["cut_offset"] is None:
+        sys.stderr.write("Salvage %s: nothing to recover, no complete %s\n" %
+                         (filename, "BAM header" if salvage["bam"] else "block"))
+        return salvage
+    kept = 100.0 * salvage["cut_offset"] / max(salvage["size"], 1)
+    if salvage["bam"]:
+        sys.stderr.write("Salvage %s: %i complete BAM records up to offset %i (%.1f%% of the file)\n" %
+                         (filename, salvage["records"], salvage["cut_offset"], kept))
+    else:
+        sys.stderr.write("Salvage %s: not a BAM file, complete blocks up to offset %i (%.1f%% of the file)\n" %
+                         (filename, salvage["cut_offset"], kept))
+    if repair_dir is not None:
+        repaired_filename = os.path.join(repair_dir, os.path.basename(filename))
+        if os.path.abspath(repaired_filename) == os.path.abspath(filename):
+            sys_exit("Not overwriting %s with its repaired copy" % filename)
+        write_repaired(filename, salvage["cut_offset"], repaired_filename)
+        sys.stderr.write("Wrote repaired copy %s of %i bytes\n" %
+                         (repaired_filename, salvage["cut_offset"] + len(BGZF_EOF)))
+    return salvage
+
+def inflate_bgzf(data):
+    """Returns the inflated data of all gzip members in data (a truncated last member is inflated partially)"""
+    chunks = []
+    while data:
+        inflater = zlib.decompressobj(31)
+        chunks.append(inflater.decompress(data))
+        data = inflater.unused_data
+    return "".join(chunks)
+
+def max_index_offset(data, csi):
+    """Returns the largest virtual offset in the bins (and linear index) of an inflated BAI or CSI index.
+
+    The pseudo-bin holds counts as well as offsets and is skipped. Raises
+    struct.error if the index is truncated.
+    """
+    pos = 4
+    if csi:
+        min_shift, depth, l_aux = struct.unpack_from("<iii", data, pos)
+        pos += 12 + l_aux
+        pseudo_bin = ((1 << (depth * 3 + 3)) - 1) // 7 + 1
+    else:
+        pseudo_bin = BAI_PSEUDO_BIN
+    largest = 0
+    n_ref = struct.unpack_from("<i", data, pos)[0]
+    pos += 4
+    for ref in range(n_ref):
+        n_bin = struct.unpack_from("<i", data, pos)[0]
+        pos += 4
+        for index in range(n_bin):
+            bin = struct.unpack_from("<I", data, pos)[0]
+            pos += 12 if csi else 4
+            n_chunk = struct.unpack_from("<i", data, pos)[0]
+            pos += 4
+            if bin != pseudo_bin and n_chunk:
+                largest = max(largest, max(struct.unpack_from("<%iQ" % (2 * n_chunk), data, pos)))
+            pos += 16 * n_chunk
+        if not csi:
+            n_intv = struct.unpack_from("<i", data, pos)[0]
+            pos += 4
+            if n_intv:
+                largest = max(largest, max(struct.unpack_from("<%iQ" % n_intv, data, pos)))
+            pos += 8 * n_intv
+    return largest
+
+def check_index(filename):
+    """Checks the .bai or .csi index of a BAM file.
+
+    Looks for file.bam.bai, file.bai and file.bam.csi, checks the magic bytes,
+    that the index is not older than the BAM and that no virtual offset in it
+    points past the end of the BAM. Returns a dict with the index path, its
+    status (ok, no_index, bad_index, stale_index, index_past_eof or
+    index_error) and a message.
+    """
+    result = {"index": None, "index_status": "no_index",
+              "index_message": "No .bai or .csi index for %s" % filename}
+    candidates = [filename + ".bai", os.path.splitext(filename)[0] + ".bai", filename + ".csi"]
+    try:
+        for index_filename in candidates:
+            if os.path.isfile(index_filename):
+                break
+        else:
+            return result
+        result["index"] = index_filename
+        csi = index_filename.endswith(".csi")
+        h = open(index_filename, "rb")
+        data = h.read()
+        h.close()
+        if csi:
+            if not data.startswith(BGZF_MAGIC):
+                data = ""
+            else:
+                try:
+                    data = inflate_bgzf(data)
+                except zlib.error:
+                    data = ""
+        if data[:4] != ("CSI\x01" if csi else "BAI\x01"):
+            result["index_status"] = "bad_index"
+            result["index_message"] = "Index %s does not start with the %s magic" % (index_filename, "CSI" if csi else "BAI")
+            return result
+        try:
+            largest = max_index_offset(data, csi)
+        except struct.error:
+            result["index_status"] = "bad_index"
+            result["index_message"] = "Index %s is truncated" % index_filename
+            return result
+        bam_stat = os.stat(filename)
+        if os.stat(index_filename).st_mtime < bam_stat.st_mtime:
+            result["index_status"] = "stale_index"
+            result["index_message"] = "Index %s is older than %s" % (index_filename, filename)
+        elif largest >> 16 > bam_stat.st_size:
+            result["index_status"] = "index_past_eof"
+            result["index_message"] = "Index %s points to offset %i past the end of %s (%i bytes)" % \
+                                      (index_filename, largest >> 16, filename, bam_stat.st_size)
+        else:
+            result["index_status"] = "ok"
+            result["index_message"] = "Index %s is valid" % index_filename
+    except (IOError, OSError) as e:
+        result["index_status"] = "index_error"
+        result["index_message"] = "Can not read the index of %s: %s" % (filename, e)
+    return result
+
+def fix_bam(filename, deep=False, inflate=False, pool=None, processes=1, salvage=False, repair_dir=None):
+    result = check_bam(filename, deep, inflate, pool, processes)
+    if result["status"] in ("missing", "not_bam", "error"):
+        sys_exit(result["message"])
+    sys.stderr.write(result["message"] + "\n")
+    if salvage and result["status"] in ("no_eof", "corrupt"):
+        report_salvage(filename, repair_dir)
+    # if result["status"] == "no_eof":
+    #     sys.stderr.write("Adding EOF block to %s\n" % filename)
+    #     h = open(filename, "ab")
+    #     h.write(BGZF_EOF)
+    #     h.close()
+
+def find_bams(paths):
+    """Yields the given files, and the .bam files below the given directories, once each"""
+    seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            filenames = []
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                filenames.extend([os.path.join(root, name) for name in sorted(files) if name.endswith(".bam")])
+        else:
+            filenames = [path]
+        for filename in filenames:
+            if os.path.abspath(filename) not in seen:
+                seen.add(os.path.abspath(filename))
+                yield filename
+
+def format_field(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return "%.6f" % value
+    return str(value)
+
+def write_report(results, report_filename, report_format):
+    if report_format == "json":
+        h = open(report_filename, "w")
+        json.dump(results, h, indent=1, sort_keys=True)
+        h.write("\n")
+        h.close()
+    else:
+        h = open(report_filename, "w")
+        h.write("\t".join(REPORT_FIELDS) + "\n")
+        for result in results:
+            h.write("\t".join([format_field(result.get(field)) for field in REPORT_FIELDS]) + "\n")
+        h.close()
+
+class VerificationCache(object):
+    """SQLite cache of (path, size, mtime, inode) -> check result.
+
+    A cached result is used while the file's stat() is unchanged, its check
+    mode is at least as thorough as the requested one and it is not older
+    than max_age seconds. Missing files and read errors are not cached.
+    Only use it from one thread.
+    """
+
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                                "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, "
+                                "mode TEXT, status TEXT, blocks INTEGER, bad_offset INTEGER, "
+                                "message TEXT, checked_at REAL)")
+        self.connection.commit()
+
+    def lookup(self, filename, mode, max_age=None):
+        """Returns the cached result for filename, or None"""
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        row = self.connection.execute("SELECT size, mtime, inode, mode, status, blocks, bad_offset, message, checked_at "
+                                      "FROM results WHERE path = ?", (os.path.abspath(filename),)).fetchone()
+        if row is None:
+            return None
+        size, mtime, inode, cached_mode, status, blocks, bad_offset, message, checked_at = row
+        if (size, mtime, inode) != (stat.st_size, stat.st_mtime, stat.st_ino):
+            return None
+        if CHECK_MODES.index(cached_mode) < CHECK_MODES.index(mode):
+            return None
+        if max_age is not None and time.time() - checked_at > max_age:
+            return None
+        return {"path": filename, "status": status, "size": size, "seconds": 0.0, "blocks": blocks,
+                "bad_offset": bad_offset, "cached": True, "message": message}
+
+    def store(self, result, stat, mode):
+        """Stores a result, with the stat() of the file taken before it was checked"""
+        if result["status"] in ("missing", "error") or stat is None:
+            return
+        self.connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (os.path.abspath(result["path"]), stat.st_size, stat.st_mtime, stat.st_ino,
+                                 mode, result["status"], result["blocks"], result["bad_offset"],
+                                 result["message"], time.time()))
+
+    def invalidate(self, paths):
+        """Forgets the results of the given files and of everything below the given directories"""
+        for path in paths:
+            path = os.path.abspath(path)
+            self.connection.execute("DELETE FROM results WHERE path = ? OR substr(path, 1, ?) = ?",
+                                    (path, len(path) + 1, path.rstrip(os.sep) + os.sep))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+def check_batch(paths, jobs=16, report_filename=None, report_format="tsv",
+                deep=False, inflate=False, pool=None, processes=1, cache=None, max_age=None,
+                index=False):
+    """Checks all BAMs below paths in a pool of jobs threads.
+
+    The checks are seek bound, so on network filesystems threads overlap the
+    waiting. Bad files are reported and the scan goes on. With a
+    VerificationCache, files with a valid cached result are only stat()ed.
+    With index the .bai/.csi index of every BAM is checked too (see
+    check_index), also for cached results. Returns the results in the order
+    of the scan.
+    """
+    mode = "inflate" if inflate else "deep" if deep else "eof"
+    filenames = list(find_bams(paths))
+    results = [None] * len(filenames)
+    to_check = []
+    for position, filename in enumerate(filenames):
+        if cache is not None:
+            results[position] = cache.lookup(filename, mode, max_age)
+        if results[position] is None:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                stat = None
+            to_check.append((position, filename, stat))
+    sys.stderr.write("Checking %i of %i files with %i threads\n" % (len(to_check), len(filenames), jobs))
+
+    counts = {}
+    index_counts = {}
+    checked = 0
+    threads = ThreadPool(jobs)
+    try:
+        def check(task):
+            position, filename, stat = task
+            return position, stat, check_bam(filename, deep, inflate, pool, processes)
+
+        for position, stat, result in threads.imap(check, to_check, chunksize=16):
+            result["cached"] = False
+            results[position] = result
+            if cache is not None:
+                cache.store(result, stat, mode)
+            checked += 1
+            if checked % 10000 == 0:
+                sys.stderr.write("Checked %i of %i files\n" % (checked, len(to_check)))
+        if index:
+            indexed = [result for result in results if result["status"] not in ("not_bam", "missing", "error")]
+            for result, index_result in zip(indexed, threads.imap(check_index, [result["path"] for result in indexed],
+                                                                   chunksize=16)):
+                result.update(index_result)
+    finally:
+        threads.close()
+        threads.join()
+        if cache is not None:
+            cache.close()
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+        if result["status"] != "ok":
+            sys.stderr.write(result["message"] + "\n")
+        if result.get("index_status") is not None:
+            index_counts[result["index_status"]] = index_counts.get(result["index_status"], 0) + 1
+            if result["index_status"] != "ok":
+                sys.stderr.write(result["index_message"] + "\n")
+    sys.stderr.write("Summary: %s\n" % ", ".join(["%s=%i" % (status, counts[status])
+                                                  for status in sorted(counts)]))
+    if index:
+        sys.stderr.write("Index summary: %s\n" % ", ".join(["%s=%i" % (status, index_counts[status])
+                                                            for status in sorted(index_counts)]))
+    if report_filename is not None:
+        write_report(results, report_filename, report_format)
+    return results
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="usage: %prog bamfile.bam [bamfile2.bam ... bamfileN.bam]\n" +
+                                   "       %prog --batch [options] file.bam|directory [...]")
+    parser.add_option("-b", "--batch", action="store_true", default=False,
+                      help="check all .bam files below the given directories in parallel, continue past bad files and write a report")
+    parser.add_option("-j", "--jobs", type="int", default=16, metavar="N",
+                      help="number of files checked concurrently in batch mode [default: 16]")
+    parser.add_option("-r", "--report", metavar="FILE",
+                      help="write a per-file report with status and timing in batch mode")
+    parser.add_option("-d", "--deep", action="store_true", default=False,
+                      help="walk every BGZF block and report the offset of the first bad block")
+    parser.add_option("-i", "--inflate", action="store_true", default=False,
+                      help="with --deep, also inflate every block and verify its CRC32 and ISIZE")
+    parser.add_option("-p", "--processes", type="int", default=1, metavar="N",
+                      help="with --deep, split large files across N processes [default: 1]")
+    parser.add_option("-x", "--index", action="store_true", default=False,
+                      help="in batch mode, also check that every BAM has a .bai/.csi index that is valid, not older than the BAM and not pointing past its end")
+    parser.add_option("-s", "--salvage", action="store_true", default=False,
+                      help="for files without EOF or with a bad block, report the last complete block and the complete BAM records before it")
+    parser.add_option("-o", "--repair-dir", metavar="DIR",
+                      help="with --salvage, write repaired copies into DIR that end at the last complete record and have an EOF block")
+    parser.add_option("-c", "--cache", metavar="FILE",
+                      help="SQLite cache of results in batch mode; unchanged files (same size, mtime and inode) are not read again")
+    parser.add_option("--recheck-older-than", type="float", metavar="DAYS",
+                      help="with --cache, check files again whose cached result is older than DAYS")
+    parser.add_option("--invalidate", action="store_true", default=False,
+                      help="with --cache, forget the cached results of the given files and directories before checking")
+    parser.add_option("-f", "--format", choices=["tsv", "json"], default=None, metavar="tsv|json",
+                      help="report format [default: json if the report name ends with .json, else tsv]")
+    (options, args) = parser.parse_args()
+
+    if len(args) == 0:
+        sys_exit("Takes one or more BGZF/BAM filenames as arguments (edits in place)")
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if options.processes < 1:
+        parser.error("--processes must be at least 1")
+    if options.inflate and not options.deep:
+        parser.error("--inflate needs --deep")
+    if options.index and not options.batch:
+        parser.error("--index needs --batch")
+    if options.salvage and options.batch:
+        parser.error("--salvage works on single files, not with --batch")
+    if options.repair_dir is not None and not options.salvage:
+        parser.error("--repair-dir needs --salvage")
+    if options.repair_dir is not None and not os.path.isdir(options.repair_dir):
+        parser.error("--repair-dir %s is not a directory" % options.repair_dir)
+    if options.cache is not None and not options.batch:
+        parser.error("--cache needs --batch")
+    if (options.recheck_older_than is not None or options.invalidate) and options.cache is None:
+        parser.error("--recheck-older-than and --invalidate need --cache")
+
+    pool = None
+    if options.deep and options.processes > 1:
+        pool = multiprocessing.Pool(options.processes)
+
+    if not options.batch:
+        for bam_filename in args:
+            fix_bam(bam_filename, options.deep, options.inflate, pool, options.processes,
+                    options.salvage, options.repair_dir)
     else:
-        sys.stderr.write("No EOF present in %s\n" % filename)
-        # sys.stderr.write("Adding EOF block to %s\n" % filename)
-        # h = open(filename, "ab")
-        # h.write(eof)
-        # h.close()
-
-if len(sys.argv) == 1:
-    sys_exit("Takes one or more BGZF/BAM filenames as arguments (edits in place)")
-for bam_filename in sys.argv[1:]:
-    fix_bam(bam_filename)
+        report_format = options.format
+        if report_format is None:
+            report_format = "json" if str(options.report).endswith(".json") else "tsv"
+        cache = None
+        if options.cache is not None:
+            cache = VerificationCache(options.cache)
+            if options.invalidate:
+                cache.invalidate(args)
+        max_age = None
+        if options.recheck_older_than is not None:
+            max_age = options.recheck_older_than * 24 * 3600
+        results = check_batch(args, options.jobs, options.report, report_format,
+                              options.deep, options.inflate, pool, options.processes, cache, max_age,
+                              options.index)
+        if [result for result in results if result["status"] != "ok" or
+            result.get("index_status") not in (None, "ok")]:
+            sys.exit(1)
@@ -0,0 +1,197 @@
+#opening of plain and gzip/BGZF compressed files for the dose, PCA and beagle conversion scripts
+#(convertDose.py, convertDoseGonl.py, convertDoseBatch.py, doseStore.py, convertPCA.py, convert_beagle_reference_to_impute2.py)
+#input is recognised by the gzip magic number, whatever its name; output is compressed when its name ends with .gz or .bgz.
+#the (de)compression runs in a child process (bgzip, pigz or gzip, the first one installed), so it overlaps with the parsing
+#in the script; without any of them it runs in a thread with zlib (GzipReader) or the gzip module, which overlaps too as zlib releases the GIL.
+#BGZF files are multi member gzip files, so all of them read BGZF, and bgzip writes it (readable by gunzip, and indexable)
+
+import os
+import gzip
+import zlib
+import errno
+import signal
+import threading
+import subprocess
+
+#bytes buffered between the (de)compression and the script
+BUFFER_SIZE = 4 * 1024 * 1024
+GZIP_MAGIC = '\x1f\x8b'
+#compressed bytes inflated at a time by GzipReader
+INFLATE_SIZE = 64 * 1024
+#programs that (de)compress gzip and BGZF with -d and -c, in order of preference
+PROGRAMS = ['bgzip', 'pigz', 'gzip']
+
+def findProgram():
+	#return the path of the first of PROGRAMS on the PATH, or None
+	for name in PROGRAMS:
+		for directory in os.environ.get('PATH', '').split(os.pathsep):
+			path = os.path.join(directory, name)
+			if os.path.isfile(path) and os.access(path, os.X_OK):
+				return path
+	return None
+
+def isCompressed(filename):
+	#whether the file starts with the gzip magic number (gzip and BGZF)
+	f = open(filename, 'rb')
+	magic = f.read(len(GZIP_MAGIC))
+	f.close()
+	return magic == GZIP_MAGIC
+
+def isCompressedName(filename):
+	#whether output to filename is compressed
+	return filename.endswith('.gz') or filename.endswith('.bgz')
+
+def restoreSigpipe():
+	#python ignores SIGPIPE and the child would inherit that; with the default a child whose pipe is closed early just stops
+	signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+class GzipReader(object):
+	#reads the data of a gzip/BGZF file (all members) as it is inflated, for GzipThread. unlike the gzip module,
+	#which drops what it inflated in a read that fails, all data before a truncation or corruption is read before the error
+	def __init__(self, filename):
+		self.name = filename
+		self.f = open(filename, 'rb')
+		self.inflater = None
+
+	def read(self, size=-1):
+		#returns the data of the next INFLATE_SIZE compressed bytes that give any, whatever size; '' at the end
+		while True:
+			compressed = self.f.read(INFLATE_SIZE)
+			if not compressed:
+				if self.inflater is not None and not self.memberEnded():
+					raise IOError(self.name+': unexpected end of file')
+				return ''
+			chunks = []
+			try:
+				while compressed:
+					if self.inflater is None:
+						self.inflater = zlib.decompressobj(31)
+					chunks.append(self.inflater.decompress(compressed))
+					#data after the end of a member starts the next member
+					compressed = self.inflater.unused_data
+					if compressed:
+						self.inflater = None
+			except zlib.error, e:
+				raise IOError(self.name+': '+str(e))
+			data = ''.join(chunks)
+			if data:
+				return data
+
+	def memberEnded(self):
+		#whether the last member is complete: after its end (and CRC check), any more input is unused
+		probe = self.inflater.copy()
+		try:
+			probe.decompress('\x00')
+		except zlib.error:
+			return False
+		return probe.unused_data != ''
+
+	def close(self):
+		self.f.close()
+
+class GzipThread(threading.Thread):
+	#copies between a pipe and a gzip file, for when there is no program to do it.
+	#like a process it has wait(), which returns 0 or raises the error of the copy
+	def __init__(self, source, target):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.source = source
+		self.target = target
+		self.error = None
+
+	def run(self):
+		try:
+			try:
+				while True:
+					data = self.source.read(BUFFER_SIZE)
+					if not data:
+						break
+					self.target.write(data)
+			except IOError, e:
+				#a broken pipe is a reader that stopped early, not an error
+				if e.errno != errno.EPIPE:
+					self.error = e
+			except Exception, e:
+				self.error = e
+		finally:
+			for f in [self.source, self.target]:
+				try:
+					f.close()
+				except IOError, e:
+					if e.errno != errno.EPIPE and self.error is None:
+						self.error = e
+
+	def poll(self):
+		#None while the copy runs, like a process
+		if self.isAlive():
+			return None
+		return 0
+
+	def wait(self):
+		self.join()
+		if self.error is not None:
+			raise IOError('(de)compression of '+self.name+' failed: '+str(self.error))
+		return 0
+
+class PipeFile(object):
+	#the pipe from or to a (de)compressing child process or GzipThread, which is waited for when the pipe is closed.
+	#everything else comes from the pipe, so it is read, iterated and written like a file
+	def __init__(self, name, process, pipe):
+		self.name = name
+		self.process = process
+		self.pipe = pipe
+
+	def __getattr__(self, attr):
+		return getattr(self.pipe, attr)
+
+	def __iter__(self):
+		return iter(self.pipe)
+
+	def close(self):
+		if self.pipe.closed:
+			return
+		#a reader that closes the pipe before the end, while the child still writes, stops it with SIGPIPE; that is not an error.
+		#any other signal (e.g. the child was killed) is, as the input then just looks shorter
+		early = 'r' in self.pipe.mode and self.process.poll() is None
+		self.pipe.close()
+		returnCode = self.process.wait()
+		if returnCode == -signal.SIGPIPE and early:
+			return
+		if returnCode < 0:
+			raise IOError('(de)compression of '+self.name+' was stopped by signal '+str(-returnCode))
+		if returnCode > 0:
+			raise IOError('(de)compression of '+self.name+' failed with exit status '+str(returnCode))
+
+def openInput(filename, mode='rb'):
+	#open a plain or gzip/BGZF compressed file for reading; mode only applies to plain files ('rU' for universal newlines).
+	#closing the file raises IOError if the decompression failed, e.g. on a truncated file
+	if not isCompressed(filename):
+		return open(filename, mode, BUFFER_SIZE)
+	program = findProgram()
+	if program is None:
+		read, write = os.pipe()
+		thread = GzipThread(GzipReader(filename), os.fdopen(write, 'wb'))
+		thread.name = filename
+		thread.start()
+		return PipeFile(filename, thread, os.fdopen(read, 'rb', BUFFER_SIZE))
+	process = subprocess.Popen([program, '-d', '-c', filename], stdout=subprocess.PIPE, bufsize=BUFFER_SIZE, preexec_fn=restoreSigpipe)
+	return PipeFile(filename, process, process.stdout)
+
+def openOutput(filename, mode='wb'):
+	#open a file for writing, compressed if its name ends with .gz or .bgz.
+	#closing the file raises IOError if the compression failed
+	if not isCompressedName(filename):
+		return open(filename, mode, BUFFER_SIZE)
+	program = findProgram()
+	if program is None:
+		read, write = os.pipe()
+		thread = GzipThread(os.fdopen(read, 'rb'), gzip.open(filename, 'wb'))
+		thread.name = filename
+		thread.start()
+		return PipeFile(filename, thread, os.fdopen(write, 'wb', BUFFER_SIZE))
+	out = open(filename, 'wb')
+	try:
+		process = subprocess.Popen([program, '-c'], stdin=subprocess.PIPE, stdout=out, bufsize=BUFFER_SIZE, preexec_fn=restoreSigpipe)
+	finally:
+		out.close()
+	return PipeFile(filename, process, process.stdin)
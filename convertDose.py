@@ -4,36 +4,38 @@
 #using plink you can read this via plink --fam d.fam --dosage a.txt list format=1
 #the a.txt file contains a list of all .dose files
 
-#######################
-#create argument parser
-#######################
+import os
+import re
+import csv
 import optparse
-parser = optparse.OptionParser(usage='usage: %prog -s subsfile -d dosagefile -o outputfile\nChoose option -h for extensive help')
-parser.add_option('-s', '--subsetFile', metavar='FILE', help='tab delimited file with two columns defining selectedIds and pseudoIds')
-parser.add_option('-d', '--doseFile', metavar='FILE', help='.dose file in beagle single dosage format, i.e. header: SNP A1 A2 F1 I1 F2 I2.. and data rs123 A T 1.99 0.11 (so value per 2 headers)')
-parser.add_option('-o', '--outFile', metavar='FILE', help='where the output will be written to')
-parser.add_option('-t', '--test', help='when this option is set to True then only 1000 lines will be converted',default=False)
-(options, args) = parser.parse_args()
-
-print options
-if options.subsetFile==None or options.doseFile==None or options.outFile==None:
-	parser.print_help()
-	exit()
+import itertools
+import idMapping
+import compressedFiles
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+#a dosage is 0, 1 or 2, with or without decimals, and not above 2
+DOSAGE = re.compile(r'(?:[01](?:\.[0-9]+)?|2(?:\.0+)?)$')
+#the dosage texts that matched DOSAGE, so the row by row engine matches every distinct text only once
+validDosages = set()
 
 ###################################################
 #read subsetFile into two lists, of old and new ids
 ###################################################
-import csv
-csvReader = csv.reader(open(options.subsetFile, 'rb'), delimiter='\t')
-selectedIds = []
-pseudoIds = {}
-for row in csvReader:
-	selectedIds.append(row[1])
-	pseudoIds[row[1]]=row[3]
-
-if options.test:
-	for el in selectedIds:
-		print el+'='+pseudoIds[el]
+def loadStudies(subsetFiles, outFiles, test=False):
+	#read the mapping of every study, to be converted together in one read of a dose file
+	studies = []
+	for subsetFile, outFile in zip(subsetFiles, outFiles):
+		selectedIds, pseudoIds = idMapping.readIdMapping(subsetFile)
+		studies.append({'subsetFile': subsetFile, 'outFile': outFile, 'selectedIds': selectedIds, 'pseudoIds': pseudoIds})
+
+		if test:
+			for el in selectedIds:
+				print el+'='+pseudoIds[el]
+	return studies
 
 ##########################################################################################
 #iterate through dose file, and rename columns in first row remember what indexes to keep.
@@ -41,149 +43,373 @@ if options.test:
 #expected data=rs1234 A T 1.99 0.69 (one column per individual)
 ##########################################################################################
 
-csvReader = csv.reader(open(options.doseFile, 'rb'), delimiter='\t', skipinitialspace=True,quoting=csv.QUOTE_NONE)
-csvWriter = csv.writer(open(options.outFile, 'wb'), delimiter='\t')
-count = 0
-
-selectedColHeaders = [0,1,2]
-selectedCols = [0,1,2]
-noElements = 0
-#check if a familySEPid is split by " " or "\t"
-#tab = True
-for row in csvReader:
-
-	if count == 0:
-	        #if first row then find out what columns to keep and rename those with new ids
-		print 'filtering data headers'
-	
-		noElements = len(row)
-		idx = 0
-
-		#select cols
-		myheader = [row[0],row[1],row[2]]
-		for col in row:
-
-			#print 'testing col: '+col+' on idx '+str(idx)
-
-			#[0,1,2] are always included
-			if idx > 2:
-
-				#print 'business '+str(idx)
-                        	#are the family and identifiers seperated by tab (skip=true) or space?
-                        	family = row[idx-1]
-                        	id = row[idx]
-                        	#if " " in col:
-				#	tab = False
-                                #id = col.partition(" ")[2]
-                                #family = col.partition(" ")[0]
-                        	
-				#print 'testing id ['+id+'] family ['+family+']'
-
-				if id in selectedIds:
-					#because of single dose format the data column idx is half of header column idx
-					#if tab:
-					selectedCols.append( 3 + (idx-3)/2)
-					#else:
-					#selectedCols.append(idx)
-					
-					#print 'mapping '+id
-					
-					#if tab:
-					selectedColHeaders.append(idx-1)
-					#selectedColHeaders.append(idx)
-
-					myheader.append(family)
-					myheader.append(pseudoIds[id])
-					#myheader.append(pseudoIds[id])
-
-				else:
-					if id != 1:
-						print 'skipping '+id
-			#skip
-			idx = idx+1
-			
-			#progress monitoring
-			if idx % 1000 == 0:
-				print 'filtered header index: index'+str(idx)
-
-		#write the header
-                csvWriter.writerow(myheader)
-
-		#debug info
-		#if tab:
-		#		print 'selected samples: '+str(len(selectedIds))+', available geno samples: '+str((idx-3)/2)+', filtered geno samples: '+str( (len(selectedCols)-3) /2 )
-		#else:
-		print 'selected samples: '+str(len(selectedIds))+', available geno samples: '+str(idx - 3)+', filtered geno samples: '+str(len(selectedCols) - 3)
-
-	else:		
-		#filter the row into 'myvalues' and write to csv
+def splitBlock(block):
+	#find the field boundaries of a block of whole lines with numpy.
+	#returns the block as bytes and the positions of the separators after each field (rows x columns),
+	#or None for blocks that a plain split on tabs and newlines would treat differently from the csv module
+	#(quotes, spaces, \r, ragged rows); those go through csv row by row, so the output is the same either way
+	if '"' in block or ' ' in block or '\r' in block:
+		return None
+	if not block.endswith('\n'):
+		block = block + '\n'
+	data = numpy.frombuffer(block, dtype=numpy.uint8)
+	isNewline = data == 10
+	seps = numpy.flatnonzero(isNewline | (data == 9)).astype(numpy.int32)
+	noRows = int(isNewline.sum())
+	noCols = int(numpy.flatnonzero(isNewline[seps])[0]) + 1
+	if len(seps) != noRows * noCols or not isNewline[seps[noCols - 1::noCols]].all():
+		return None
+	return data, seps.reshape(noRows, noCols)
+
+def selectBlock(data, seps, selectedCols):
+	#gather the bytes of the selected fields of all rows at once, with tab separators and csv \r\n line ends
+	noRows = seps.shape[0]
+
+	#start and length of every selected field including its separator, plus one byte for the \r of csv line ends
+	starts = numpy.empty_like(seps)
+	starts.ravel()[0] = 0
+	starts.ravel()[1:] = seps.ravel()[:-1] + 1
+	starts = starts[:, selectedCols]
+	lengths = seps[:, selectedCols] - starts + 1
+	lengths[:, -1] += 1
+	starts = starts.ravel()
+	lengths = lengths.ravel()
+	ends = numpy.cumsum(lengths)
+
+	#source index of every output byte: runs of +1 that jump to the start of the next field
+	index = numpy.ones(ends[-1], dtype=numpy.int32)
+	index[0] = starts[0]
+	index[ends[:-1]] = starts[1:] - (starts[:-1] + lengths[:-1] - 1)
+	numpy.cumsum(index, out=index)
+	output = data.take(index, mode='clip')
+	output[ends - 1] = 9
+	lineEnds = ends.reshape(noRows, -1)[:, -1]
+	output[lineEnds - 2] = 13
+	output[lineEnds - 1] = 10
+	return output.tostring()
+
+def checkBlock(data, seps, dosageCols):
+	#check the given dosage columns of a block split by splitBlock, the same way as DOSAGE.
+	#returns the row and column of the first bad dosage, or None.
+	#the n-th bytes of all dosages are checked at once, for n up to the longest dosage (usually 5: 0.123)
+	if len(dosageCols) == 0:
+		return None
+	starts = seps[:, [col - 1 for col in dosageCols]].ravel() + 1
+	lengths = seps[:, dosageCols].ravel() - starts
+	#byte values minus '0', so digits are 0..9 and anything else wraps around above 9
+	first = data.take(starts) - ord('0')
+	good = first <= 2
+	good &= (lengths == 1) | ((data.take(starts + 1) == ord('.')) & (lengths >= 3))
+	notTwo = first != 2
+	for n in range(2, int(lengths.max())):
+		chars = data.take(starts + n, mode='clip') - ord('0')
+		good &= (lengths <= n) | ((chars <= 9) & (notTwo | (chars == 0)))
+	bad = numpy.flatnonzero(~good)
+	if len(bad) == 0:
+		return None
+	return int(bad[0]) / len(dosageCols), dosageCols[int(bad[0]) % len(dosageCols)]
+
+def badRow(rowNo, row, message):
+	#describe a bad data row for the QC report
+	return 'row '+str(rowNo)+' ('+''.join(row[:1])+') '+message
+
+def convertRow(row, studies, noCols, rowNo):
+	#write the selected columns of one data row to the output of every study, checking them on the way.
+	#returns a description of the row if it is bad, after which nothing more should be written
+	if len(row) != noCols:
+		return badRow(rowNo, row, 'has '+str(len(row))+' columns instead of '+str(noCols))
+	for study in studies:
 		myvalues = []
- 
-		for col in selectedCols:
+		for col in study['selectedCols']:
 			myvalues.append(row[col])
-		csvWriter.writerow(myvalues)
-
-		#debug info
-		if count % 1000 == 0:
-			print 'converting row '+str(count)
-
-	#for testing purpose you can break early
-	if options.test and count >= 100:
-		break
-	count=count+1
+		if not validDosages.issuperset(myvalues[3:]):
+			for value in set(myvalues[3:]).difference(validDosages):
+				if not DOSAGE.match(value):
+					return badRow(rowNo, row, 'has dosage \''+value+'\', not a number in 0..2')
+				validDosages.add(value)
+		study['csvWriter'].writerow(myvalues)
+		study['noSnps'] = study['noSnps'] + 1
+	return None
+
+def convertBlock(block, studies, noCols, rowNo):
+	#write the selected columns of a block of whole lines to the output of every study, checking them on the way.
+	#rowNo is the number of the first row of the block. returns a description of the first bad row, or None
+	split = splitBlock(block)
+	if split is not None and split[1].shape[1] == noCols:
+		data, seps = split
+		#the dosages of all studies are checked before anything of the block is written
+		bad = checkBlock(data, seps, sorted(set([col for study in studies for col in study['selectedCols'] if col > 2])))
+		if bad is not None:
+			row, col = bad
+			snp = data[(seps[row - 1, -1] + 1 if row else 0):seps[row, 0]].tostring()
+			value = data[seps[row, col - 1] + 1:seps[row, col]].tostring()
+			return badRow(rowNo + row, [snp], 'has dosage \''+value+'\', not a number in 0..2')
+		for study in studies:
+			study['outFile'].write(selectBlock(data, seps, study['selectedCols']))
+			study['noSnps'] = study['noSnps'] + seps.shape[0]
+		return None
+	#anything else, including rows with the wrong number of columns, goes through csv row by row
+	for row in csv.reader(block.rstrip('\n').split('\n'), delimiter='\t', skipinitialspace=True,quoting=csv.QUOTE_NONE):
+		error = convertRow(row, studies, noCols, rowNo)
+		if error is not None:
+			return error
+		rowNo = rowNo + 1
+	return None
+
+def selectHeader(row, selectedIds, pseudoIds):
+	#find out what columns to keep and rename those with new ids
+	#returns the data columns to keep and the new header
+	selectedColHeaders = [0,1,2]
+	selectedCols = [0,1,2]
+	noElements = len(row)
+	idx = 0
+
+	#select cols
+	myheader = [row[0],row[1],row[2]]
+	for col in row:
+
+		#print 'testing col: '+col+' on idx '+str(idx)
+
+		#[0,1,2] are always included
+		if idx > 2:
+
+			#print 'business '+str(idx)
+			#are the family and identifiers seperated by tab (skip=true) or space?
+			family = row[idx-1]
+			id = row[idx]
+			#if " " in col:
+			#	tab = False
+			#id = col.partition(" ")[2]
+			#family = col.partition(" ")[0]
+
+			#print 'testing id ['+id+'] family ['+family+']'
+
+			if id in pseudoIds:
+				#because of single dose format the data column idx is half of header column idx
+				selectedCols.append( 3 + (idx-3)/2)
+				selectedColHeaders.append(idx-1)
+
+				myheader.append(family)
+				myheader.append(pseudoIds[id])
 
-##############################################################################################
-#QC: check if the headers in outfile match our selectedIds (and do not contain any previousIds)
-##############################################################################################
-print 'check of output whether all ids are properly converted'
-
-import os
-csvReader = csv.reader(open(options.outFile, 'rb'), delimiter='\t', skipinitialspace=True,quoting=csv.QUOTE_NONE)
-
-foundPseudoIds = []
-expectedPseudoIds = pseudoIds.values()
-count = 0
-for row in csvReader:
-
-	if count == 0:
-		#check headers
-		idx=0
-		for col in row:
-
-			#for each col >2 should be pseudoIds
-			if idx >2:
-				#if not found we delete outfile and give error
-				id = col.partition(" ")[2]
-				if id not in expectedPseudoIds:
-					#os.remove(options.outFile)
-					print 'conversion FAILED: id \''+col+'\' not a pseudoId' 
-					exit()
-
-				#remember id so we can count
-				foundPseudoIds.append(id)
 			else:
-				#verify no original ids are in there
-				if col in selectedIds:
-					os.remove(options.outFile)
-                                        print 'conversion FAILED: id \''+col+'\' not a pseudoId'
-                                        exit()
-
-			idx=idx+1
-					
-	if count == 1:
-		#check values todo
-		print 'have to check values still!'
-
-	if count > 1:
-		break
-
-	count=count+1
-
-#check for missing 
-if len(foundPseudoIds) != len(expectedPseudoIds):
-	for key in pseudoIds.keys():
-		if pseudoIds[key] not in foundPseudoIds:
-			print 'WARNING: mapping  '+key+'='+pseudoIds[key]+' not in dosage file'
-
-print 'conversion completed'
+				if id != 1:
+					print 'skipping '+id
+		#skip
+		idx = idx+1
+
+		#progress monitoring
+		if idx % 1000 == 0:
+			print 'filtered header index: index'+str(idx)
+
+	print 'selected samples: '+str(len(selectedIds))+', available geno samples: '+str(idx - 3)+', filtered geno samples: '+str(len(selectedCols) - 3)
+	return selectedCols, myheader
+
+def checkHeader(myheader, study):
+	#check the renamed header of a study: family, pseudoId pairs after SNP A1 A2, with every pseudoId mapped once
+	#and no original ids left. returns a description of the first problem, or None
+	expectedPseudoIds = set(study['pseudoIds'].values())
+	study['pseudoIdsFound'] = myheader[4::2]
+	for col in myheader[:3]:
+		#verify no original ids are in there
+		if col in study['pseudoIds']:
+			return 'id \''+col+'\' not a pseudoId'
+	for id in study['pseudoIdsFound']:
+		if id not in expectedPseudoIds:
+			return 'id \''+id+'\' not a pseudoId'
+	if len(set(study['pseudoIdsFound'])) != len(study['pseudoIdsFound']):
+		return 'pseudoId \''+[id for id in study['pseudoIdsFound'] if study['pseudoIdsFound'].count(id) > 1][0]+'\' is in the header more than once'
+	if len(study['pseudoIdsFound']) != len(study['selectedCols']) - 3:
+		return 'the header has '+str(len(study['pseudoIdsFound']))+' pseudoIds for '+str(len(study['selectedCols']) - 3)+' data columns'
+	return None
+
+def removeOutput(studies):
+	#remove the (partial) output of a failed conversion, so it can not be mistaken for a delivered file
+	for study in studies:
+		outFile = study['outFile']
+		if not isinstance(outFile, str):
+			#a conversion that stopped on an exception may not have closed it
+			try:
+				outFile.close()
+			except IOError:
+				pass
+			outFile = outFile.name
+		if os.path.isfile(outFile):
+			os.remove(outFile)
+			print 'removed '+outFile
+
+def convertDose(doseFile, studies, store=None, engine='auto', blockSize=16, test=False, query=None):
+	#convert doseFile (or the store with prefix store) for every study; returns False if the QC fails
+	#test mode stops after 100 rows, which the row by row engine does.
+	#query is the index and rows from doseIndex.queryRows, to convert only those rows; they are read in blocks at their offsets
+	useBlocks = (engine != 'csv' and numpy is not None and not test and store is None) or query is not None
+
+	for study in studies:
+		study['outFile'] = compressedFiles.openOutput(study['outFile'])
+		study['csvWriter'] = csv.writer(study['outFile'], delimiter='\t')
+	if store is not None:
+		#only the header goes through the loop below, the data rows are rendered from the store
+		import doseStore
+		store = doseStore.openStore(store)
+		csvReader = [store['header']]
+	else:
+		if query is None:
+			doseFile = compressedFiles.openInput(doseFile)
+			blocks = iter(lambda: doseFile.readlines(blockSize * 1024 * 1024), [])
+		else:
+			#only the header is read from the start, the data rows are read at their offsets in the index
+			import doseIndex
+			blocks = doseIndex.readRows(doseFile, query[0], query[1])
+			doseFile = compressedFiles.openInput(doseFile)
+		#the header is read ahead, so the block engine can go on with plain reads after it
+		csvReader = csv.reader(itertools.chain([doseFile.readline()], doseFile), delimiter='\t', skipinitialspace=True,quoting=csv.QUOTE_NONE)
+	count = 0
+	error = None
+
+	#check if a familySEPid is split by " " or "\t"
+	#tab = True
+	for row in csvReader:
+
+		if count == 0:
+			#if first row then find out what columns to keep for every study, and write its renamed header
+			print 'filtering data headers'
+			if (len(row) - 3) % 2 != 0:
+				error = 'the header has '+str(len(row))+' columns, not SNP A1 A2 and two per individual'
+				break
+			#because of single dose format a data row has one column per two header columns
+			noCols = 3 + (len(row) - 3) / 2
+			for study in studies:
+				print 'study '+study['subsetFile']
+				study['selectedCols'], myheader = selectHeader(row, study['selectedIds'], study['pseudoIds'])
+				error = checkHeader(myheader, study)
+				if error is not None:
+					break
+				study['csvWriter'].writerow(myheader)
+				study['noSnps'] = 0
+			if error is not None:
+				break
+
+		else:
+			#filter the row into 'myvalues' for every study and write to csv
+			error = convertRow(row, studies, noCols, count)
+			if error is not None:
+				break
+
+			#debug info
+			if count % 1000 == 0:
+				print 'converting row '+str(count)
+
+		#for testing purpose you can break early
+		count=count+1
+		if test and count > 100:
+			break
+
+		#the block engine takes over after the header
+		if useBlocks:
+			break
+
+	if useBlocks and error is None:
+		if query is None:
+			print 'converting blocks of '+str(blockSize)+' MB'
+		else:
+			print 'converting '+str(len(query[1]))+' SNPs read at their offsets'
+		for lines in blocks:
+			error = convertBlock(''.join(lines), studies, noCols, count)
+			if error is not None:
+				break
+			count = count + len(lines)
+			print 'converting row '+str(count)
 
+	if store is not None and error is None:
+		#the store has whole rows and checked dosages, so only the number of SNPs is counted
+		count = 1 + store['noSnps']
+		for study in studies:
+			print 'converting from store for '+study['subsetFile']
+			try:
+				study['noSnps'] = doseStore.writeSelected(store, study['selectedCols'], study['csvWriter'])
+			except ValueError, e:
+				error = str(e)
+				break
+
+	#closing also finishes the (de)compression of compressed files, which fails on e.g. a truncated input
+	files = [study['outFile'] for study in studies]
+	if store is None:
+		files.insert(0, doseFile)
+	for f in files:
+		try:
+			f.close()
+		except IOError, e:
+			if error is None:
+				error = str(e)
+			elif f is doseFile:
+				#a damaged input is the cause of the error it gave on the way, e.g. a short last row
+				error = str(e)+' (which caused: '+error+')'
+
+	######################################################################################################
+	#QC: the headers and every written row were checked on the way, check that no SNP was lost in between
+	######################################################################################################
+	if error is None:
+		for study in studies:
+			if study['noSnps'] != count - 1:
+				error = study['outFile'].name+' has '+str(study['noSnps'])+' SNPs instead of '+str(count - 1)
+				break
+	if error is not None:
+		print 'conversion FAILED: '+error
+		removeOutput(studies)
+		return False
+
+	for study in studies:
+		print 'checked the header and '+str(study['noSnps'])+' SNPs of '+study['outFile'].name
+		#check for missing 
+		for key in idMapping.missingIds(study['selectedIds'], study['pseudoIds'], set(study['pseudoIdsFound'])):
+			print 'WARNING: mapping  '+key+'='+study['pseudoIds'][key]+' not in dosage file'
+
+	print 'conversion completed'
+	return True
+
+if __name__ == "__main__":
+	#######################
+	#create argument parser
+	#######################
+	parser = optparse.OptionParser(usage='usage: %prog -s subsfile -d dosagefile|-S storeprefix -o outputfile\n       %prog -s study1subsfile -o study1outputfile -s study2subsfile -o study2outputfile ... -d dosagefile|-S storeprefix\nChoose option -h for extensive help')
+	parser.add_option('-s', '--subsetFile', metavar='FILE', action='append', help='tab delimited file with two columns defining selectedIds and pseudoIds; repeat -s and -o to convert for several studies in one read of the dose file')
+	parser.add_option('-d', '--doseFile', metavar='FILE', help='.dose file in beagle single dosage format, i.e. header: SNP A1 A2 F1 I1 F2 I2.. and data rs123 A T 1.99 0.11 (so value per 2 headers), plain or gzip/BGZF compressed')
+	parser.add_option('-o', '--outFile', metavar='FILE', action='append', help='where the output will be written to, one per -s in the same order; compressed if the name ends with .gz or .bgz')
+	parser.add_option('-S', '--store', metavar='PREFIX', help='read the dosages from a binary store made by doseStore.py instead of a .dose file')
+	parser.add_option('-t', '--test', help='when this option is set to True then only 1000 lines will be converted',default=False)
+	parser.add_option('-e', '--engine', choices=['auto','csv','numpy'], default='auto', help='csv converts row by row, numpy converts blocks of rows with one column selection per block (same output); auto uses numpy if it is installed [default: auto]')
+	parser.add_option('-b', '--blockSize', type='int', default=16, metavar='MB', help='megabytes of whole rows per block for the numpy engine [default: 16]')
+	parser.add_option('-x', '--snpFile', metavar='FILE', help='convert only the SNPs in the first column of this file, read at their offsets in the index made by doseIndex.py')
+	parser.add_option('-r', '--region', metavar='REGION', help='convert only the SNPs in a region like 1:1000-2000 or 1, read at their offsets in the index made by doseIndex.py (also with -x)')
+	parser.add_option('-I', '--indexFile', metavar='FILE', help='index of the dose file for -x and -r [default: dosagefile.idx.npz]')
+	(options, args) = parser.parse_args()
+
+	print options
+	if options.subsetFile==None or (options.doseFile==None) == (options.store==None) or options.outFile==None:
+		parser.print_help()
+		exit()
+	if len(options.subsetFile) != len(options.outFile):
+		print 'give one -o outputfile for every -s subsfile'
+		exit()
+	if options.engine == 'numpy' and numpy is None:
+		print 'the numpy engine needs numpy, which is not installed'
+		exit()
+	if options.blockSize < 1 or options.blockSize > 1024:
+		print 'the block size must be between 1 and 1024 MB'
+		exit()
+
+	query = None
+	if options.snpFile is not None or options.region is not None:
+		if options.doseFile is None or numpy is None:
+			print 'the SNPs of -x and -r are read from a .dose file with its index, which needs numpy'
+			exit()
+		import doseIndex
+		try:
+			query = doseIndex.queryRows(options.doseFile, options.indexFile, options.snpFile, options.region)
+		except ValueError, e:
+			print 'conversion FAILED: '+str(e)
+			exit()
+
+	studies = loadStudies(options.subsetFile, options.outFile, options.test)
+	if not convertDose(options.doseFile, studies, options.store, options.engine, options.blockSize, options.test, query):
+		exit()
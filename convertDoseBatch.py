@@ -0,0 +1,128 @@
+#this script converts all chromosome .dose files of a release with convertDose.py, in a pool of processes
+#the mappings are read once and shared with the worker processes
+#every chromosome gets its own log, and the exit status is nonzero if any chromosome fails
+#the output of study S for chromosome N is OUTDIR/S_chrN.dose, as test.py expects (OUTDIR/S_chrN.dose.gz with -z)
+
+import os
+import re
+import sys
+import glob
+import time
+import optparse
+import traceback
+import multiprocessing
+import convertDose
+
+#the end of the name of a plain or compressed dose file
+DOSE_NAME = r'\.dose(\.b?gz)?$'
+
+#the studies, read once before the worker processes are forked
+batchStudies = []
+
+def findDoseFiles(paths):
+	#return the .dose (or compressed .dose.gz) files in the given directories and matching the given file globs, largest first,
+	#so the largest chromosome starts first and bounds the wall time
+	doseFiles = []
+	for path in paths:
+		if os.path.isdir(path):
+			doseFiles.extend([os.path.join(path, item) for item in os.listdir(path) if re.search(DOSE_NAME, item)])
+		else:
+			doseFiles.extend(glob.glob(path))
+	doseFiles = sorted(set(doseFiles))
+	doseFiles.sort(key=os.path.getsize, reverse=True)
+	return doseFiles
+
+def chromosomeName(doseFile):
+	#the chromosome of e.g. ImputedGenotypeDosageFormatPLINK-Chr12.dose(.gz), or the file name without .dose(.gz)
+	match = re.search(r'chr([^._-]+)' + DOSE_NAME, os.path.basename(doseFile), re.IGNORECASE)
+	if match:
+		return match.group(1)
+	return re.sub(DOSE_NAME, '', os.path.basename(doseFile))
+
+def convertChromosome(task):
+	#convert one dose file for all studies, with its output in its own log; returns (chromosome, ok, message, seconds)
+	doseFile, chromosome, logFile, engine, blockSize, extension = task
+	start = time.time()
+	log = open(logFile, 'w')
+	stdout = sys.stdout
+	sys.stdout = log
+	studies = []
+	try:
+		try:
+			studies = [dict(study, outFile=os.path.join(study['outDir'], study['studyId']+'_chr'+chromosome+extension)) for study in batchStudies]
+			print 'converting '+doseFile
+			if convertDose.convertDose(doseFile, studies, None, engine, blockSize):
+				message = ''
+			else:
+				message = 'QC failed'
+		except (Exception, SystemExit), e:
+			traceback.print_exc(file=log)
+			message = e.__class__.__name__+': '+str(e)
+			#a failed QC removes the output already, this is for a conversion that stopped on an exception
+			convertDose.removeOutput(studies)
+	finally:
+		sys.stdout = stdout
+		log.close()
+	return chromosome, message == '', message, time.time() - start
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage='usage: %prog -s subsfile -i studyId -o outdir [-s subsfile2 -i studyId2 -o outdir2 ...] [-j jobs] dosedir|"dosefileglob" [...]\nChoose option -h for extensive help')
+	parser.add_option('-s', '--subsetFile', metavar='FILE', action='append', help='tab delimited file with two columns defining selectedIds and pseudoIds, repeat for several studies')
+	parser.add_option('-i', '--studyId', metavar='ID', action='append', help='study id used in the output names (ID_chrN.dose), one per -s')
+	parser.add_option('-o', '--outDir', metavar='DIR', action='append', help='directory for the output of the study, one per -s')
+	parser.add_option('-l', '--logDir', metavar='DIR', help='directory for the per chromosome logs [default: the first outdir]')
+	parser.add_option('-j', '--jobs', type='int', default=multiprocessing.cpu_count(), metavar='N', help='number of chromosomes converted at the same time [default: number of cpus]')
+	parser.add_option('-z', '--compress', action='store_true', default=False, help='write compressed ID_chrN.dose.gz files')
+	parser.add_option('-e', '--engine', choices=['auto','csv','numpy'], default='auto', help='engine of convertDose.py [default: auto]')
+	parser.add_option('-b', '--blockSize', type='int', default=16, metavar='MB', help='megabytes of whole rows per block for the numpy engine [default: 16]')
+	(options, args) = parser.parse_args()
+
+	print options
+	if options.subsetFile==None or options.studyId==None or options.outDir==None or len(args) == 0:
+		parser.print_help()
+		exit()
+	if not len(options.subsetFile) == len(options.studyId) == len(options.outDir):
+		print 'give one -i studyId and one -o outdir for every -s subsfile'
+		exit()
+	if options.jobs < 1:
+		print 'the number of jobs must be at least 1'
+		exit()
+	logDir = options.logDir or options.outDir[0]
+	for directory in options.outDir + [logDir]:
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	doseFiles = findDoseFiles(args)
+	if len(doseFiles) == 0:
+		print 'no .dose or .dose.gz files found'
+		sys.exit(1)
+	chromosomes = [chromosomeName(doseFile) for doseFile in doseFiles]
+	if len(set(chromosomes)) != len(chromosomes):
+		print 'the .dose files do not have unique chromosome names: '+', '.join(doseFiles)
+		sys.exit(1)
+
+	for subsetFile, studyId, outDir in zip(options.subsetFile, options.studyId, options.outDir):
+		batchStudies.extend(convertDose.loadStudies([subsetFile], [None]))
+		batchStudies[-1]['studyId'] = studyId
+		batchStudies[-1]['outDir'] = outDir
+
+	tasks = [(doseFile, chromosome, os.path.join(logDir, 'chr'+chromosome+'.log'), options.engine, options.blockSize, '.dose.gz' if options.compress else '.dose')
+		for doseFile, chromosome in zip(doseFiles, chromosomes)]
+	print 'converting '+str(len(tasks))+' dose files for '+str(len(batchStudies))+' studies with '+str(options.jobs)+' processes'
+	failed = []
+	pool = multiprocessing.Pool(options.jobs)
+	try:
+		for chromosome, ok, message, seconds in pool.imap_unordered(convertChromosome, tasks):
+			if ok:
+				print 'chr'+chromosome+' converted in '+str(int(seconds))+' s'
+			else:
+				print 'chr'+chromosome+' FAILED after '+str(int(seconds))+' s: '+message+', see '+os.path.join(logDir, 'chr'+chromosome+'.log')
+				failed.append(chromosome)
+	finally:
+		pool.close()
+		pool.join()
+
+	if failed:
+		print 'conversion FAILED for chromosomes '+', '.join(failed)
+		sys.exit(1)
+	print 'conversion completed'
@@ -8,28 +8,41 @@
 #create argument parser
 #######################
 import optparse
-parser = optparse.OptionParser(usage='usage: %prog -s subsfile -d dosagefile -o outputfile\nChoose option -h for extensive help')
+parser = optparse.OptionParser(usage='usage: %prog -s subsfile -d dosagefile|-S storeprefix -o outputfile\nChoose option -h for extensive help')
 parser.add_option('-s', '--subsetFile', metavar='FILE', help='tab delimited file with two columns defining selectedIds and pseudoIds')
-parser.add_option('-d', '--doseFile', metavar='FILE', help='.dose file in beagle single dosage format, i.e. header: SNP A1 A2 F1 I1 F2 I2.. and data rs123 A T 1.99 0.11 (so value per 2 headers)')
-parser.add_option('-o', '--outFile', metavar='FILE', help='where the output will be written to')
+parser.add_option('-d', '--doseFile', metavar='FILE', help='.dose file in beagle single dosage format, i.e. header: SNP A1 A2 F1 I1 F2 I2.. and data rs123 A T 1.99 0.11 (so value per 2 headers), plain or gzip/BGZF compressed')
+parser.add_option('-o', '--outFile', metavar='FILE', help='where the output will be written to, compressed if the name ends with .gz or .bgz')
+parser.add_option('-S', '--store', metavar='PREFIX', help='read the dosages from a binary store made by doseStore.py instead of a .dose file')
+parser.add_option('-x', '--snpFile', metavar='FILE', help='convert only the SNPs in the first column of this file, read at their offsets in the index made by doseIndex.py')
+parser.add_option('-r', '--region', metavar='REGION', help='convert only the SNPs in a region like 1:1000-2000 or 1, read at their offsets in the index made by doseIndex.py (also with -x)')
+parser.add_option('-I', '--indexFile', metavar='FILE', help='index of the dose file for -x and -r [default: dosagefile.idx.npz]')
 parser.add_option('-t', '--test', help='when this option is set to True then only 1000 lines will be converted',default=False)
 (options, args) = parser.parse_args()
 
 print options
-if options.subsetFile==None or options.doseFile==None or options.outFile==None:
+if options.subsetFile==None or (options.doseFile==None) == (options.store==None) or options.outFile==None:
 	parser.print_help()
 	exit()
 
+query = None
+if options.snpFile is not None or options.region is not None:
+	if options.doseFile is None:
+		print 'the SNPs of -x and -r are read from a .dose file with its index'
+		exit()
+	import doseIndex
+	try:
+		query = doseIndex.queryRows(options.doseFile, options.indexFile, options.snpFile, options.region)
+	except ValueError, e:
+		print 'conversion FAILED: '+str(e)
+		exit()
+
 ###################################################
 #read subsetFile into two lists, of old and new ids
 ###################################################
 import csv
-csvReader = csv.reader(open(options.subsetFile, 'rb'), delimiter='\t')
-selectedIds = []
-pseudoIds = {}
-for row in csvReader:
-	selectedIds.append(row[1])
-	pseudoIds[row[1]]=row[3]
+import idMapping
+import compressedFiles
+selectedIds, pseudoIds = idMapping.readIdMapping(options.subsetFile)
 
 if options.test:
 	for el in selectedIds:
@@ -41,8 +54,21 @@ if options.test:
 #expected data=rs1234 A T 1.99 0.69 (one column per individual)
 ##########################################################################################
 
-csvReader = csv.reader(open(options.doseFile, 'rb'), delimiter='\t', skipinitialspace=True,quoting=csv.QUOTE_NONE)
-csvWriter = csv.writer(open(options.outFile, 'wb'), delimiter='\t')
+if options.store is not None:
+	#only the header goes through the loop below, the data rows are rendered from the store
+	import doseStore
+	store = doseStore.openStore(options.store)
+	csvReader = [store['header']]
+else:
+	doseFile = compressedFiles.openInput(options.doseFile)
+	lines = doseFile
+	if query is not None:
+		#the header is read from the start, the selected rows at their offsets
+		import itertools
+		lines = itertools.chain([doseFile.readline()], itertools.chain.from_iterable(doseIndex.readRows(options.doseFile, query[0], query[1])))
+	csvReader = csv.reader(lines, delimiter='\t', skipinitialspace=True,quoting=csv.QUOTE_NONE)
+outFile = compressedFiles.openOutput(options.outFile)
+csvWriter = csv.writer(outFile, delimiter='\t')
 count = 0
 
 selectedColHeaders = [0,1,2]
@@ -79,7 +105,7 @@ for row in csvReader:
                         	
 				print 'testing id ['+id+']'
 
-				if id in selectedIds:
+				if id in pseudoIds:
 					#because of single dose format the data column idx is half of header column idx
 					#if tab:
 					#	selectedCols.append( 3 + (idx-3)/2)
@@ -129,16 +155,32 @@ for row in csvReader:
 		break
 	count=count+1
 
+if options.store is not None:
+	try:
+		doseStore.writeSelected(store, selectedCols, csvWriter)
+	except ValueError, e:
+		print 'conversion FAILED: '+str(e)
+		exit()
+else:
+	#closing finishes the decompression, which fails on e.g. a truncated input
+	try:
+		doseFile.close()
+	except IOError, e:
+		print 'conversion FAILED: '+str(e)
+		exit()
+
+outFile.close()
+
 ##############################################################################################
 #QC: check if the headers in outfile match our selectedIds (and do not contain any previousIds)
 ##############################################################################################
 print 'check of output whether all ids are properly converted'
 
 import os
-csvReader = csv.reader(open(options.outFile, 'rb'), delimiter='\t', skipinitialspace=True,quoting=csv.QUOTE_NONE)
+csvReader = csv.reader(compressedFiles.openInput(options.outFile), delimiter='\t', skipinitialspace=True,quoting=csv.QUOTE_NONE)
 
-foundPseudoIds = []
-expectedPseudoIds = pseudoIds.values()
+foundPseudoIds = set()
+expectedPseudoIds = set(pseudoIds.values())
 count = 0
 for row in csvReader:
 
@@ -157,10 +199,10 @@ for row in csvReader:
 					exit()
 
 				#remember id so we can count
-				foundPseudoIds.append(id)
+				foundPseudoIds.add(id)
 			else:
 				#verify no original ids are in there
-				if col in selectedIds:
+				if col in pseudoIds:
 					os.remove(options.outFile)
                                         print 'conversion FAILED: id \''+col+'\' not a pseudoId'
                                         exit()
@@ -177,10 +219,8 @@ for row in csvReader:
 	count=count+1
 
 #check for missing 
-if len(foundPseudoIds) != len(expectedPseudoIds):
-	for key in pseudoIds.keys():
-		if pseudoIds[key] not in foundPseudoIds:
-			print 'WARNING: mapping  '+key+'='+pseudoIds[key]+' not in dosage file'
+for key in idMapping.missingIds(selectedIds, pseudoIds, foundPseudoIds):
+	print 'WARNING: mapping  '+key+'='+pseudoIds[key]+' not in dosage file'
 
 print 'conversion completed'
 
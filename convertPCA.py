@@ -6,8 +6,8 @@
 import optparse
 parser = optparse.OptionParser(usage='usage: %prog -s subsfile -d pcafile -o outputfile\nChoose option -h for extensive help')
 parser.add_option('-s', '--subsetFile', metavar='FILE', help='tab delimited file with two columns defining selectedIds and pseudoIds')
-parser.add_option('-d', '--pcaFile', metavar='FILE', help='the pca file)')
-parser.add_option('-o', '--outFile', metavar='FILE', help='where the output will be written to')
+parser.add_option('-d', '--pcaFile', metavar='FILE', help='the pca file, plain or gzip/BGZF compressed')
+parser.add_option('-o', '--outFile', metavar='FILE', help='where the output will be written to, compressed if the name ends with .gz or .bgz')
 (options, args) = parser.parse_args()
 
 print options
@@ -19,12 +19,9 @@ if options.subsetFile==None or options.pcaFile==None or options.outFile==None:
 #read subsetFile into two lists, of old and new ids
 ###################################################
 import csv
-csvReader = csv.reader(open(options.subsetFile, 'rU'), delimiter='\t')
-selectedIds = []
-pseudoIds = {}
-for row in csvReader:
-	selectedIds.append(row[1])
-	pseudoIds[row[1]]=row[3]
+import idMapping
+import compressedFiles
+selectedIds, pseudoIds = idMapping.readIdMapping(options.subsetFile)
 
 ##########################################################################################
 #iterate through pca file
@@ -32,8 +29,9 @@ for row in csvReader:
 #then rename to pseudoId
 ##########################################################################################
 
-csvReader = csv.reader(open(options.pcaFile, 'rU'), delimiter='\t')
-f = open(options.outFile, 'wb')
+pcaFile = compressedFiles.openInput(options.pcaFile, 'rU')
+csvReader = csv.reader(pcaFile, delimiter='\t')
+f = compressedFiles.openOutput(options.outFile)
 csvWriter = csv.writer(f, delimiter='\t')
 count = 0
 
@@ -41,7 +39,7 @@ for row in csvReader:
 	if count == 0:
 		csvWriter.writerow(row)
 	else:
-		if row[0] in selectedIds:
+		if row[0] in pseudoIds:
 			#filter the row into 'myvalues' and write to csv
 			myvalues = []
 			for col in row:
@@ -54,6 +52,12 @@ for row in csvReader:
 				print 'converting row '+str(count)
 	count=count+1
 
+#closing finishes the decompression, which fails on e.g. a truncated input
+try:
+	pcaFile.close()
+except IOError, e:
+	print 'conversion FAILED: '+str(e)
+	exit()
 f.close()
 
 ##############################################################################################
@@ -62,10 +66,10 @@ f.close()
 print 'check of output whether all ids are properly converted'
 
 import os
-csvReader = csv.reader(open(options.outFile, 'rU'), delimiter='\t')
+csvReader = csv.reader(compressedFiles.openInput(options.outFile, 'rU'), delimiter='\t')
 
-foundPseudoIds = []
-expectedPseudoIds = pseudoIds.values()
+foundPseudoIds = set()
+expectedPseudoIds = set(pseudoIds.values())
 count = 0
 for row in csvReader:
 	if count > 0:
@@ -74,13 +78,13 @@ for row in csvReader:
 			os.remove(options.outFile)
 			print 'conversion FAILED: id \''+row[0]+'\' not a pseudoId'
 			exit()
-		if row[0] in selectedIds:
+		if row[0] in pseudoIds:
 			os.remove(options.outFile)
 			print 'conversion FAILED: id \''+row[0]+'\' not a pseudoId'
 			exit()
 
 		#remember id so we can count
-		foundPseudoIds.append(row[0])
+		foundPseudoIds.add(row[0])
 
 		#debug info
 		if count % 1000 == 0:
@@ -92,11 +96,9 @@ print str(len(foundPseudoIds)) +' versus '+str(len(expectedPseudoIds))
 
 #check for missing 
 f = open(options.outFile+'.missing', 'w')
-if len(foundPseudoIds) != len(expectedPseudoIds):
-	for key in pseudoIds:
-		if pseudoIds[key] not in foundPseudoIds:
-			f.write('WARNING: mapping  '+key+'='+pseudoIds[key]+' not in pca file\n')
-			print 'WARNING: mapping  '+key+'='+pseudoIds[key]+' not in pca file'
+for key in idMapping.missingIds(selectedIds, pseudoIds, foundPseudoIds):
+	f.write('WARNING: mapping  '+key+'='+pseudoIds[key]+' not in pca file\n')
+	print 'WARNING: mapping  '+key+'='+pseudoIds[key]+' not in pca file'
 
 print 'conversion completed'
 
@@ -1,3 +1,5 @@
+#inputs may be plain or gzip/BGZF compressed, outputs are compressed if their names end with .gz or .bgz
+import compressedFiles
 
 def error_unknown_genotype(lc, gen, al1, al2):
 	raise Exception("Unknown genotype: " + gen + " in line: " + str(lc) + ". Accepter alleles according to markers file: " + al1 + " , " + al2)
@@ -9,13 +11,13 @@ def Convert_beagle_to_impute2_reference_user_Kantale(
 	output_legend_filename = None,
 	):
 
-	input_beagle_file = open(input_beagle_filename)
-	input_markers_file = open(input_markers_filename)
+	input_beagle_file = compressedFiles.openInput(input_beagle_filename)
+	input_markers_file = compressedFiles.openInput(input_markers_filename)
 
-	output_hap_file = open(output_legend_filename, 'w')
-	output_legend_file = open(output_legend_filename, 'w')
+	output_hap_file = compressedFiles.openOutput(output_hap_filename, 'w')
+	output_legend_file = compressedFiles.openOutput(output_legend_filename, 'w')
 	#Write header tp legend file
-	output_legend_file.write('ID pos allele0 allele1')
+	output_legend_file.write('ID pos allele0 allele1\n')
 	lc = 0
 
 	for beagle_line in input_beagle_file:
@@ -42,8 +44,8 @@ def Convert_beagle_to_impute2_reference_user_Kantale(
 		legend_to_print = [rs_id, pos, allele0, allele1]
 
 		genotypes = beagle_line_s[2:]
-		hap_to_print = [0 if genotype == allele0 else 
-							1 if genotype == allele1 else 
+		hap_to_print = ['0' if genotype == allele0 else 
+							'1' if genotype == allele1 else 
 								error_unknown_genotype(lc, genotype, allele0, allele1) 
 									for genotype in genotypes]
 
@@ -51,12 +53,15 @@ def Convert_beagle_to_impute2_reference_user_Kantale(
 		output_hap_file.write(str.join(' ', hap_to_print) + '\n')
 		output_legend_file.write(str.join(' ', legend_to_print) + '\n')
 
+	#closing the inputs finishes their decompression, which fails on e.g. a truncated file
+	input_beagle_file.close()
+	input_markers_file.close()
 	output_hap_file.close()
 	output_legend_file.close()
 
 import sys
 
 if __name__ == '__main__':
-	Convert_beagle_to_impute2_reference_user_Kantale(sys.args[1], sys.args[2], sys.args[3], sys.args[4])
+	Convert_beagle_to_impute2_reference_user_Kantale(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
 
 
@@ -0,0 +1,249 @@
+#this script indexes the rows of a .dose file (beagle single dosage or GoNL format), so convertDose.py and convertDoseGonl.py
+#can convert a few SNPs or a region (-x / -r) by seeking to their rows instead of reading the whole file.
+#the index of D.dose is D.dose.idx.npz, with
+#  offsets       the offset of every data row, in file order
+#  ids, idRows   the SNP ids, sorted, and their rows
+#  keys, keyRows the positions (chromosome number << 32 | position), sorted, and their rows
+#  chromosomes   the chromosome names of the positions, without 'chr'
+#  fileSize, fileTime  of the indexed file, to notice a changed file
+#positions come from a plink .map file (-m: chromosome, SNP, cM, position) or else from SNP ids like 1:12345 or chr1:12345_A_G.
+#plain files are indexed by byte offset and BGZF compressed files (bgzip) by virtual offset
+#(block offset << 16 | offset in the block); other gzip files can not be read at an offset
+
+import os
+import re
+import csv
+import zlib
+import struct
+import optparse
+import numpy
+
+#the position in a SNP id like 1:12345, chr1:12345 or X:12345:A:G
+POSITION_ID = re.compile(r'(?:chr)?([0-9A-Za-z]+):([0-9]+)')
+#a region like 1:1000-2000, chr1:1000-2000 or 1 (whole chromosome)
+REGION = re.compile(r'(?:chr)?([0-9A-Za-z]+)(?::([0-9]+)-([0-9]+))?$')
+BGZF_MAGIC = '\x1f\x8b\x08\x04'
+
+def isBgzf(filename):
+	#whether the file starts with a BGZF block (gzip with the BC extra field)
+	f = open(filename, 'rb')
+	header = f.read(16)
+	f.close()
+	return header[:4] == BGZF_MAGIC and header[12:14] == 'BC'
+
+class BgzfReader(object):
+	#reads the lines of a BGZF file from virtual offsets, inflating one block at a time
+	def __init__(self, filename):
+		self.name = filename
+		self.f = open(filename, 'rb')
+		self.seek(0)
+
+	def readBlock(self, blockOffset):
+		#inflate the block at blockOffset; the data is empty at the end of the file
+		self.f.seek(blockOffset)
+		header = self.f.read(18)
+		self.blockOffset = blockOffset
+		self.pos = 0
+		if len(header) < 18:
+			self.data = ''
+			self.nextBlock = blockOffset
+			return
+		if header[:4] != BGZF_MAGIC or header[12:14] != 'BC':
+			raise IOError(self.name+' has no BGZF block at offset '+str(blockOffset))
+		size = struct.unpack('<H', header[16:18])[0] + 1
+		self.data = zlib.decompress(self.f.read(size - 18)[:-8], -15)
+		self.nextBlock = blockOffset + size
+
+	def seek(self, virtualOffset):
+		self.readBlock(virtualOffset >> 16)
+		self.pos = virtualOffset & 0xFFFF
+
+	def tell(self):
+		return self.blockOffset << 16 | self.pos
+
+	def readline(self):
+		parts = []
+		while True:
+			if self.pos >= len(self.data):
+				if self.nextBlock == self.blockOffset:
+					break
+				self.readBlock(self.nextBlock)
+				continue
+			end = self.data.find('\n', self.pos)
+			if end >= 0:
+				parts.append(self.data[self.pos:end + 1])
+				self.pos = end + 1
+				break
+			parts.append(self.data[self.pos:])
+			self.pos = len(self.data)
+		return ''.join(parts)
+
+	def close(self):
+		self.f.close()
+
+def openDose(doseFile):
+	#open a plain or BGZF dose file for reading rows at their index offsets
+	if isBgzf(doseFile):
+		return BgzfReader(doseFile)
+	if open(doseFile, 'rb').read(2) == BGZF_MAGIC[:2]:
+		raise ValueError(doseFile+' is gzip but not BGZF compressed, so its rows can not be read at an offset; compress it with bgzip')
+	return open(doseFile, 'rb')
+
+def readMap(mapFile):
+	#read a plink .map file into a dict of SNP -> (chromosome, position)
+	positions = {}
+	for row in csv.reader(open(mapFile, 'rU'), delimiter='\t'):
+		if len(row) == 1:
+			row = row[0].split()
+		if len(row) >= 4:
+			positions[row[1]] = (stripChr(row[0]), int(row[3]))
+	return positions
+
+def stripChr(chromosome):
+	#1 for chr1 and 1
+	if chromosome.lower().startswith('chr'):
+		return chromosome[3:]
+	return chromosome
+
+def buildIndex(doseFile, indexFile=None, mapFile=None):
+	#index the data rows of doseFile; returns the number of rows
+	if indexFile is None:
+		indexFile = doseFile + '.idx.npz'
+	mapPositions = None
+	if mapFile is not None:
+		mapPositions = readMap(mapFile)
+	f = openDose(doseFile)
+	f.readline()
+
+	offsets = []
+	ids = []
+	keys = []
+	keyRows = []
+	chromosomes = {}
+	while True:
+		offset = f.tell()
+		line = f.readline()
+		if not line:
+			break
+		snp = line.split('\t', 1)[0].strip()
+		if mapPositions is not None:
+			position = mapPositions.get(snp)
+		else:
+			match = POSITION_ID.match(snp)
+			position = match and (match.group(1), int(match.group(2)))
+		if position:
+			chromosome = chromosomes.setdefault(position[0], len(chromosomes))
+			keys.append(chromosome << 32 | position[1])
+			keyRows.append(len(offsets))
+		offsets.append(offset)
+		ids.append(snp)
+		if len(offsets) % 100000 == 0:
+			print 'indexed row '+str(len(offsets))
+	f.close()
+
+	ids = numpy.array(ids, dtype='S')
+	idRows = numpy.argsort(ids, kind='mergesort')
+	keys = numpy.array(keys, dtype=numpy.int64)
+	keyOrder = numpy.argsort(keys, kind='mergesort')
+	names = sorted(chromosomes, key=chromosomes.get)
+	stat = os.stat(doseFile)
+	numpy.savez(open(indexFile, 'wb'), offsets=numpy.array(offsets, dtype=numpy.int64), ids=ids[idRows], idRows=idRows,
+		keys=keys[keyOrder], keyRows=numpy.array(keyRows, dtype=numpy.int64)[keyOrder],
+		chromosomes=numpy.array(names, dtype='S'), fileSize=stat.st_size, fileTime=stat.st_mtime)
+	if len(keys) < len(offsets):
+		print 'WARNING: '+str(len(offsets) - len(keys))+' of '+str(len(offsets))+' SNPs have no position, so only their id is indexed'
+	return len(offsets)
+
+def loadIndex(doseFile, indexFile=None):
+	#load the index of doseFile; fails if there is none or if the file changed after indexing
+	if indexFile is None:
+		indexFile = doseFile + '.idx.npz'
+	if not os.path.isfile(indexFile):
+		raise ValueError('there is no index '+indexFile+', create it with doseIndex.py -d '+doseFile)
+	npz = numpy.load(indexFile)
+	index = dict([(name, npz[name]) for name in npz.files])
+	npz.close()
+	stat = os.stat(doseFile)
+	if stat.st_size != index['fileSize'] or stat.st_mtime != index['fileTime']:
+		raise ValueError(doseFile+' changed after it was indexed in '+indexFile+', index it again')
+	index['chromosomes'] = list(index['chromosomes'])
+	return index
+
+def findSnps(index, snps):
+	#return the rows of the given SNP ids (every row of a duplicated id) and the ids that are not in the index
+	#ids longer than the longest indexed id would be cut short in its type, they can not be there anyway
+	width = index['ids'].dtype.itemsize
+	snps = list(snps)
+	query = numpy.array([snp if len(snp) <= width else '' for snp in snps], dtype=index['ids'].dtype)
+	starts = numpy.searchsorted(index['ids'], query, side='left')
+	ends = numpy.searchsorted(index['ids'], query, side='right')
+	ends[query == ''] = starts[query == '']
+	rows = [index['idRows'][start:end] for start, end in zip(starts, ends)]
+	missing = [snp for snp, start, end in zip(snps, starts, ends) if start == end]
+	return numpy.concatenate(rows + [numpy.zeros(0, dtype=numpy.int64)]), missing
+
+def findRegion(index, region):
+	#return the rows with positions in a region like 1:1000-2000 (both ends included) or 1 (whole chromosome)
+	match = REGION.match(region)
+	if not match:
+		raise ValueError('region '+region+' is not like 1:1000-2000 or 1')
+	chromosome, start, end = match.groups()
+	if chromosome not in index['chromosomes']:
+		return numpy.zeros(0, dtype=numpy.int64)
+	chromosome = index['chromosomes'].index(chromosome)
+	if start is None:
+		start, end = 0, 2 ** 32 - 1
+	first = numpy.searchsorted(index['keys'], chromosome << 32 | int(start), side='left')
+	last = numpy.searchsorted(index['keys'], chromosome << 32 | int(end), side='right')
+	return index['keyRows'][first:last]
+
+def readRows(doseFile, index, rows, blockRows=1000):
+	#yield blocks of the lines of the given rows, once each and in file order
+	offsets = index['offsets'][numpy.unique(rows)]
+	f = openDose(doseFile)
+	try:
+		for start in range(0, len(offsets), blockRows):
+			lines = []
+			for offset in offsets[start:start + blockRows]:
+				f.seek(offset)
+				lines.append(f.readline())
+			yield lines
+	finally:
+		f.close()
+
+def readSnpFile(snpFile):
+	#the SNP ids in the first column of snpFile
+	return [line.split()[0] for line in open(snpFile, 'rU') if line.strip()]
+
+def queryRows(doseFile, indexFile, snpFile, region):
+	#the rows of the SNPs in snpFile and/or in region, with a warning for every SNP that is not in the index
+	index = loadIndex(doseFile, indexFile)
+	rows = []
+	if snpFile is not None:
+		snpRows, missing = findSnps(index, readSnpFile(snpFile))
+		for snp in missing:
+			print 'WARNING: SNP '+snp+' not in dosage file'
+		rows.append(snpRows)
+	if region is not None:
+		rows.append(findRegion(index, region))
+	rows = numpy.unique(numpy.concatenate(rows + [numpy.zeros(0, dtype=numpy.int64)]))
+	print 'found '+str(len(rows))+' SNPs in the index of '+doseFile
+	return index, rows
+
+if __name__ == '__main__':
+	parser = optparse.OptionParser(usage='usage: %prog -d dosagefile [-m mapfile] [-o indexfile]\nChoose option -h for extensive help')
+	parser.add_option('-d', '--doseFile', metavar='FILE', help='.dose file in beagle single dosage or GoNL format, plain or BGZF compressed (bgzip)')
+	parser.add_option('-m', '--mapFile', metavar='FILE', help='plink .map file with the positions of the SNPs [default: positions from ids like 1:12345]')
+	parser.add_option('-o', '--indexFile', metavar='FILE', help='where the index will be written to [default: dosagefile.idx.npz]')
+	(options, args) = parser.parse_args()
+
+	print options
+	if options.doseFile==None:
+		parser.print_help()
+		exit()
+	try:
+		noSnps = buildIndex(options.doseFile, options.indexFile, options.mapFile)
+	except (ValueError, IOError), e:
+		print 'indexing FAILED: '+str(e)
+		exit(1)
+	print 'indexed '+str(noSnps)+' SNPs of '+options.doseFile
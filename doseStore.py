@@ -0,0 +1,190 @@
+#this script converts a .dose file (beagle single dosage or GoNL format) into a binary dosage store,
+#so repeated subsetting with convertDose.py -S / convertDoseGonl.py -S does not parse the text again.
+#a store with prefix P consists of
+#  P.dosage   SNP x sample matrix, memory mapped: uint8 (dosage x 100) or float16
+#  P.snps     SNP, A1 and A2 of every row, tab delimited
+#  P.samples  the header columns after SNP A1 A2, one per line
+#  P.json     matrix type, shape, number of decimals and the first three header columns
+#the text is rendered again with the largest number of decimals found in the .dose file;
+#values that are written differently in the .dose file (e.g. '2' for '2.00') are counted when the store is built
+
+import os
+import csv
+import json
+import itertools
+import optparse
+import numpy
+import compressedFiles
+
+STORE_TYPES = ['uint8', 'float16']
+#number of selected values rendered at a time by writeSelected
+BLOCK_VALUES = 1000000
+
+def valueTable(storeType, decimals):
+	#return the text of every possible stored value, indexed by the stored value
+	#(the uint8 value or the bits of the float16 value)
+	if storeType == 'uint8':
+		values = numpy.arange(256) / 100.0
+	else:
+		values = numpy.arange(65536, dtype=numpy.uint16).view(numpy.float16).astype(numpy.float64)
+	fmt = '%.' + str(decimals) + 'f'
+	return numpy.array([fmt % value for value in values], dtype=object)
+
+def storeValues(values, storeType):
+	#convert a block of dosages (floats) to the stored type; the second value tells which ones do not fit or are outside 0..2
+	if storeType == 'uint8':
+		scaled = numpy.round(values * 100)
+		bad = ~((scaled >= 0) & (scaled <= 200))
+		return numpy.where(bad, 0, scaled).astype(numpy.uint8), bad
+	stored = values.astype(numpy.float16)
+	return stored, ~((stored >= 0) & (stored <= 2))
+
+def tableIndex(stored):
+	#the index of stored values into the value table
+	if stored.dtype == numpy.float16:
+		return stored.view(numpy.uint16)
+	return stored
+
+def countDecimals(text):
+	#the number of decimals of every value of a bytes array, from its characters (the values have no NUL bytes)
+	chars = text.view(numpy.uint8).reshape(text.shape + (text.dtype.itemsize,))
+	lengths = (chars != 0).sum(-1, dtype=numpy.int8)
+	points = chars == ord('.')
+	return numpy.where(points.any(-1), lengths - points.argmax(-1) - 1, 0).astype(numpy.int8)
+
+def buildStore(doseFile, prefix, storeType='uint8', blockSize=16):
+	#convert the text dosages of doseFile to a store with the given prefix; returns the number of SNPs.
+	#the text is read in blocks of blockSize MB of whole rows, like the block engine of convertDose.py, so the memory use
+	#does not grow with the number of samples
+	inFile = compressedFiles.openInput(doseFile)
+	header = csv.reader([inFile.readline()], delimiter='\t', skipinitialspace=True,quoting=csv.QUOTE_NONE).next()
+	matrixFile = open(prefix + '.dosage', 'wb')
+	snpFile = open(prefix + '.snps', 'wb')
+	snpWriter = csv.writer(snpFile, delimiter='\t')
+	noSnps = 0
+	noCols = None
+	#per number of decimals in the text, how many values the value table with that many decimals renders the same
+	noSame = {}
+	tables = {}
+	noValues = 0
+	try:
+		for lines in iter(lambda: inFile.readlines(blockSize * 1024 * 1024), []):
+			rows = list(csv.reader(lines, delimiter='\t', skipinitialspace=True,quoting=csv.QUOTE_NONE))
+			del lines
+			if noCols is None:
+				noCols = len(rows[0])
+			for rowNo, row in enumerate(rows):
+				if len(row) != noCols:
+					raise ValueError('row '+str(noSnps + rowNo + 1)+' ('+row[0]+') has '+str(len(row))+' columns instead of '+str(noCols))
+			snpWriter.writerows([row[:3] for row in rows])
+			#one copy of the dosages as bytes, which gives the values as well as their number of decimals
+			text = numpy.array([row[3:] for row in rows], dtype='S')
+			noRows = len(rows)
+			del rows
+			try:
+				values = text.astype(numpy.float64)
+			except ValueError, e:
+				raise ValueError('can not store a dosage of the rows after SNP '+str(noSnps)+': '+str(e))
+			stored, bad = storeValues(values, storeType)
+			del values
+			if bad.any():
+				raise ValueError('dosage '+str(text[bad][0])+' is not in 0..2 or does not fit in '+storeType)
+			decimalsOf = countDecimals(text)
+			if storeType == 'uint8' and decimalsOf.size and decimalsOf.max() > 2:
+				raise ValueError('dosages with '+str(decimalsOf.max())+' decimals do not fit in uint8, use -t float16')
+			for noDecimals in numpy.unique(decimalsOf):
+				if noDecimals not in tables:
+					tables[noDecimals] = valueTable(storeType, noDecimals).astype('S')
+				same = decimalsOf == noDecimals
+				noSame[noDecimals] = noSame.get(noDecimals, 0) + int((tables[noDecimals][tableIndex(stored[same])] == text[same]).sum())
+			noValues = noValues + text.size
+			matrixFile.write(stored.tostring())
+			noSnps = noSnps + noRows
+			print 'stored row '+str(noSnps)
+	except ValueError, e:
+		#a damaged input is the cause of the error it gave on the way, e.g. a short last row
+		try:
+			inFile.close()
+		except IOError, closeError:
+			raise ValueError(str(closeError)+' (which caused: '+str(e)+')')
+		raise
+	#the store is rendered with the largest number of decimals of any value, so no digits are lost
+	decimals = int(max(noSame.keys() + [0]))
+	noDifferent = noValues - noSame.get(decimals, 0)
+	matrixFile.close()
+	snpFile.close()
+	try:
+		inFile.close()
+	except IOError, e:
+		raise ValueError(str(e))
+
+	sampleFile = open(prefix + '.samples', 'w')
+	for col in header[3:]:
+		sampleFile.write(col + '\n')
+	sampleFile.close()
+	meta = {'type': storeType, 'snps': noSnps, 'samples': (noCols or 3) - 3, 'decimals': decimals, 'header': header[:3]}
+	metaFile = open(prefix + '.json', 'w')
+	json.dump(meta, metaFile, indent=1, sort_keys=True)
+	metaFile.close()
+	if noDifferent:
+		print 'WARNING: '+str(noDifferent)+' dosages are written differently in '+doseFile+' than with '+str(decimals)+' decimals; the store renders them with '+str(decimals)+' decimals'
+	return noSnps
+
+def openStore(prefix):
+	#open a store; the matrix is memory mapped and the SNPs are read next to it when rendering, so only the rows that are rendered are read
+	metaFile = open(prefix + '.json')
+	meta = json.load(metaFile)
+	metaFile.close()
+	header = meta['header'] + [line.rstrip('\n') for line in open(prefix + '.samples')]
+	if meta['snps'] == 0:
+		matrix = numpy.zeros((0, meta['samples']), dtype=meta['type'])
+	else:
+		matrix = numpy.memmap(prefix + '.dosage', dtype=meta['type'], mode='r', shape=(meta['snps'], meta['samples']))
+	return {'header': header, 'snpFile': prefix + '.snps', 'noSnps': meta['snps'], 'matrix': matrix, 'table': valueTable(meta['type'], meta['decimals'])}
+
+def writeSelected(store, selectedCols, csvWriter, blockValues=BLOCK_VALUES):
+	#write the selected columns (indexes of a text data row, so 0..2 are SNP A1 A2) of all SNPs; returns the number of SNPs written.
+	#a block of rows is a slice of the memory map with about blockValues selected values, and the same rows of the .snps file;
+	#only its selected columns are rendered to text
+	sampleCols = [col - 3 for col in selectedCols if col > 2]
+	snpCols = [col for col in selectedCols if col <= 2]
+	matrix = store['matrix']
+	blockRows = max(1, blockValues // max(1, len(sampleCols)))
+	snpReader = csv.reader(open(store['snpFile'], 'rb'), delimiter='\t', quoting=csv.QUOTE_NONE)
+	noSnps = 0
+	for start in range(0, matrix.shape[0], blockRows):
+		block = matrix[start:start + blockRows]
+		values = store['table'][tableIndex(numpy.asarray(block[:, sampleCols]))].tolist()
+		snps = list(itertools.islice(snpReader, len(values)))
+		if len(snps) != len(values):
+			raise ValueError(store['snpFile']+' has '+str(start + len(snps))+' SNPs instead of '+str(matrix.shape[0]))
+		rows = [[snp[col] for col in snpCols] + row for snp, row in zip(snps, values)]
+		csvWriter.writerows(rows)
+		noSnps = noSnps + len(rows)
+		print 'converting row '+str(noSnps)
+	return noSnps
+
+if __name__ == '__main__':
+	parser = optparse.OptionParser(usage='usage: %prog -d dosagefile -o storeprefix [-t uint8|float16] [-b MB]\nChoose option -h for extensive help')
+	parser.add_option('-d', '--doseFile', metavar='FILE', help='.dose file in beagle single dosage or GoNL format, values 0..2, plain or gzip/BGZF compressed')
+	parser.add_option('-o', '--outPrefix', metavar='PREFIX', help='prefix of the store files (PREFIX.dosage, .snps, .samples and .json)')
+	parser.add_option('-t', '--type', choices=STORE_TYPES, default='uint8', help='uint8 stores dosage x 100 (up to 2 decimals), float16 keeps about 3 significant digits [default: uint8]')
+	parser.add_option('-b', '--blockSize', type='int', default=16, metavar='MB', help='megabytes of whole rows of text converted at a time [default: 16]')
+	(options, args) = parser.parse_args()
+
+	print options
+	if options.doseFile==None or options.outPrefix==None:
+		parser.print_help()
+		exit()
+	if options.blockSize < 1 or options.blockSize > 1024:
+		print 'the block size must be between 1 and 1024 MB'
+		exit()
+	try:
+		noSnps = buildStore(options.doseFile, options.outPrefix, options.type, options.blockSize)
+	except ValueError, e:
+		for extension in ['.dosage', '.snps', '.samples', '.json']:
+			if os.path.isfile(options.outPrefix + extension):
+				os.remove(options.outPrefix + extension)
+		print 'conversion FAILED: '+str(e)
+		exit(1)
+	print 'stored '+str(noSnps)+' SNPs in '+options.outPrefix+'.dosage'
@@ -0,0 +1,35 @@
+#shared loader for the mapping files of the dose and PCA pseudonymization scripts
+#(convertDose.py, convertDoseGonl.py, convertPCA.py)
+#a mapping file is tab delimited with the original id in column 2 and the pseudo id in column 4
+
+import csv
+
+def readIdMapping(subsetFile):
+	#read the mapping into a list of original ids (in file order) and a dict of original id -> pseudo id.
+	#membership tests go through the dict, so they do not scan the list.
+	#duplicate original ids, duplicate pseudo ids and short rows are reported in the same pass;
+	#as before, the last mapping of a duplicate original id wins
+	selectedIds = []
+	pseudoIds = {}
+	originalIds = {}
+	lineNo = 0
+	for row in csv.reader(open(subsetFile, 'rU'), delimiter='\t'):
+		lineNo = lineNo + 1
+		if len(row) < 4:
+			print 'WARNING: mapping line '+str(lineNo)+' has '+str(len(row))+' columns instead of 4, skipped'
+			continue
+		id = row[1]
+		pseudoId = row[3]
+		if id in pseudoIds:
+			print 'WARNING: id '+id+' is mapped more than once, line '+str(lineNo)+' maps it to '+pseudoId+' instead of '+pseudoIds[id]
+		else:
+			selectedIds.append(id)
+		if pseudoId in originalIds and originalIds[pseudoId] != id:
+			print 'WARNING: pseudoId '+pseudoId+' is used for both '+originalIds[pseudoId]+' and '+id
+		originalIds[pseudoId] = id
+		pseudoIds[id] = pseudoId
+	return selectedIds, pseudoIds
+
+def missingIds(selectedIds, pseudoIds, foundPseudoIds):
+	#return the original ids (in mapping order) whose pseudo id is not in foundPseudoIds (a set)
+	return [id for id in selectedIds if pseudoIds[id] not in foundPseudoIds]
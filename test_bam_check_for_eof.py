@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Tests of bam_check_for_eof.py: the batch mode with and without --index, and salvage of damaged records.
+
+Run with: python -m unittest test_bam_check_for_eof
+"""
+
+import os
+import sys
+import shutil
+import zlib
+import struct
+import tempfile
+import unittest
+import subprocess
+
+import bam_check_for_eof
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bam_check_for_eof.py")
+
+class BatchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        #A BAM that is only an EOF block passes the header and EOF checks
+        self.bam = os.path.join(self.directory, "a.bam")
+        h = open(self.bam, "wb")
+        h.write(bam_check_for_eof.BGZF_EOF)
+        h.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_index(self):
+        h = open(self.bam + ".bai", "wb")
+        h.write("BAI\x01" + struct.pack("<i", 0))
+        h.close()
+        os.utime(self.bam + ".bai", (os.stat(self.bam).st_mtime + 1,) * 2)
+
+    def run_batch(self, *options):
+        report = os.path.join(self.directory, "report.tsv")
+        devnull = open(os.devnull, "w")
+        try:
+            code = subprocess.call([sys.executable, SCRIPT, "--batch", "--report", report] + list(options) + [self.directory],
+                                   stderr=devnull)
+        finally:
+            devnull.close()
+        rows = [line.rstrip("\n").split("\t") for line in open(report)]
+        return code, [dict(zip(rows[0], row)) for row in rows[1:]]
+
+    def test_batch_without_index_ignores_missing_index(self):
+        code, rows = self.run_batch()
+        self.assertEqual(code, 0)
+        self.assertEqual(rows[0]["status"], "ok")
+        self.assertEqual(rows[0]["index_status"], "")
+
+    def test_batch_with_index_reports_missing_index(self):
+        #The only BAM is at position 0 of the scan
+        code, rows = self.run_batch("--index")
+        self.assertEqual(code, 1)
+        self.assertEqual(rows[0]["index_status"], "no_index")
+
+    def test_batch_with_index_accepts_valid_index(self):
+        self.write_index()
+        code, rows = self.run_batch("--index")
+        self.assertEqual(code, 0)
+        self.assertEqual(rows[0]["index_status"], "ok")
+        self.assertEqual(rows[0]["index"], self.bam + ".bai")
+
+    def test_check_batch_index_argument(self):
+        other = os.path.join(self.directory, "b.bam")
+        shutil.copy(self.bam, other)
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, "w")
+        try:
+            without = bam_check_for_eof.check_batch([self.directory], jobs=2)
+            checked = bam_check_for_eof.check_batch([self.directory], jobs=2, index=True)
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+        self.assertEqual([result.get("index_status") for result in without], [None, None])
+        self.assertEqual([result.get("index_status") for result in checked], ["no_index", "no_index"])
+
+def bgzf_block(data):
+    deflater = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed = deflater.compress(data) + deflater.flush()
+    return bam_check_for_eof.BGZF_HEADER + struct.pack("<H", len(compressed) + 25) + compressed + \
+        struct.pack("<Ii", zlib.crc32(data) & 0xffffffff, len(data))
+
+class SalvageTest(unittest.TestCase):
+
+    def salvage(self, *blocks):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "a.bam")
+            h = open(filename, "wb")
+            h.write("".join([bgzf_block(block) for block in blocks]))
+            h.close()
+            return bam_check_for_eof.salvage_bam(filename)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_impossible_record_size_ends_salvage(self):
+        header = "BAM\x01" + struct.pack("<ii", 0, 0)
+        record = struct.pack("<i", 36) + "x" * 36
+        for size in (-4, -100, 0, 31):
+            salvage = self.salvage(header + record * 3, struct.pack("<i", size) + "y" * 40)
+            self.assertEqual(salvage["records"], 3)
+            self.assertEqual(salvage["blocks"], 1)
+            self.assertEqual(salvage["cut_offset"], salvage["bad_offset"])
+
+    def test_negative_header_lengths_end_salvage(self):
+        for data in ("BAM\x01" + struct.pack("<i", -20) + "z" * 30,
+                     "BAM\x01" + struct.pack("<iii", 0, 1, -9) + "q" * 20):
+            salvage = self.salvage(data)
+            self.assertEqual(salvage["cut_offset"], None)
+            self.assertEqual(salvage["bad_offset"], 0)
+
+if __name__ == "__main__":
+    unittest.main()